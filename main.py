@@ -3,70 +3,1814 @@ import os
 import subprocess
 import sys
 import argparse
+import atexit
+import threading
+import queue
+import hashlib
+import json
+import sqlite3
+import io
+import mmap
+import tarfile
 import tkinter as tk
 from tkinter.filedialog import askopenfilename
-from multiprocessing import freeze_support, set_start_method
+from tkinter.messagebox import askyesno
+from multiprocessing import Pool, freeze_support, set_start_method
 from difflib import SequenceMatcher
+import numpy as np
 import pandas as pd
 import pytesseract
+if any(arg == '-B' or arg.startswith(('-B', '--batch')) for arg in sys.argv[1:]):
+    # OpenMP reads the limit once, when libtesseract is loaded by this import: in --batch the pool processes
+    # (forked, or spawned with this environment) already use all the cores, Tesseract's own threads must not
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
 import tesserocr
 from tesserocr import RIL, PSM, OEM, iterate_level
+try:
+    import pdf2image  # Needs Poppler; only for PDF input
+except ImportError:
+    pdf2image = None
 from PIL import Image, ImageDraw, ImageTk
 from functools import partial
-from time import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from time import time, perf_counter
 import random
+import bisect
+import unicodedata
+from collections import Counter
+import math
+import itertools
+import re
+from collections import OrderedDict
+import cProfile
+import pstats
+import platform
+import tempfile
+try:
+    import resource  # Peak RSS in the benchmark; not available on Windows
+except ImportError:
+    resource = None
 
 STANDARD_DPI = 500     # This DPI is now largely for OCR interpretation internally, not image conversion
 SCALED_DOWN_DPI = 100  # Still used for GUI display scaling
 
 SCALE_FACTOR = STANDARD_DPI / SCALED_DOWN_DPI
 
+PDF_DPI = 300  # Resolution the PDF pages are rendered at
+DOCUMENT_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.pdf')  # Input files (TIFFs and PDFs can be multi-page)
+
 GT_OUTPUT_DIR = 'my_gt_files'  # folder to save .gt.txt e .tif files (lines training data)
+DRAFT_GT_OUTPUT_DIR = 'my_draft_gt_files'  # folder for unverified .gt.txt e .tif files produced by --batch
+
+GT_TIFF_COMPRESSION = None  # None, 'tiff_lzw', 'tiff_adobe_deflate' or 'group4' (the line is binarised first)
+GT_WRITER_THREADS = os.cpu_count() or 1  # Threads encoding the .tif files in save_gt_files
+GT_OUTPUT_FORMAT = 'files'  # 'files': a .tif and a .gt.txt per line; 'shards': lines packed in tar shards (GtShardStore)
+GT_SHARD_MAX_BYTES = 256 * 1024 * 1024  # A new shard is started when the current one reaches this size
+GT_MANIFEST = 'gt_manifest.sqlite'  # In the output folder: one row per saved line (see GtManifest)
+
+UNICHARSET_THREADS = 8  # Threads reading the .gt.txt files for the unicharset
+UNICHARSET_NORMALIZATION_MAP = {}  # Extra mappings applied after NFC normalisation, e.g. {'\u017f': 's'} (long s)
+UNICHARSET_INDEX = '.unicharset_index.json'  # In GT_OUTPUT_DIR: characters of every file, to read only new/changed ones
+USE_UNICHARSET_EXTRACTOR = False  # Use Tesseract's unicharset_extractor instead of the built-in builder
 
 RUNTIME_ID = str(int(time())) + str(random.randint(-sys.maxsize - 1, sys.maxsize))
 
 TESSDATA_FOLDER = 'tessdata'   #specify where is your tessdata folder, with the OCR model inside
+LSTMF_FOLDER = 'lstmf'  # folder for the .lstmf files and the list.train / list.eval lists
+LSTMF_EVAL_RATIO = 0.1  # Fraction of the lines that go to list.eval
+# Parameters of Tesseract's configs/lstm.train, used when no tessdata with that config is found
+LSTM_TRAIN_PARAMS = {'disable_character_fragments': 'T', 'file_type': '.bl', 'textord_fast_pitch_test': 'T',
+                     'tessedit_zero_rejection': 'T', 'tessedit_minimal_rejection': 'F',
+                     'tessedit_write_rep_codes': 'F', 'il1_adaption_test': '1', 'edges_children_fix': 'F',
+                     'edges_childarea': '0.65', 'edges_boxarea': '0.9', 'tessedit_train_line_recognizer': 'T',
+                     'textord_no_rejects': 'T', 'tessedit_init_config_only': '0'}
 
 USE_TESSEROCR = True    # I prefer Tesserocr to Pytesseract if installed
+OCR_SINGLE_PASS = True  # Recognize the page once and read the lines from the result iterator (False: re-OCR every line)
 
-USE_MSER_TO_FIND_LEFTOVER_REGIONS = True
+USE_MSER_TO_FIND_LEFTOVER_REGIONS = True  # After the page OCR, look for ink that no line covers and OCR it too
 LEFTOVER_OCR_REGION_PADDING = 10
+LEFTOVER_BLOCK_SIZE = 4         # Ink is looked for in blocks of this many pixels (removes specks and noise)
+LEFTOVER_MIN_BLOCK_INK = 3      # Dark pixels needed in a block to count it as ink
+LEFTOVER_MIN_REGION_SIZE = 12   # Smaller regions (in pixels, width or height) are ignored
+LEFTOVER_MAX_COVERED = 0.5      # Regions already covered by the lines for more than this fraction are ignored
+LEFTOVER_VALLEY_RATIO = 0.25    # Rows with more ink than this fraction of a region's darkest rows are line cores
+LEFTOVER_MAX_LINE_RATIO = 1.5   # Candidates taller than this many line heights are cut at their lightest row
+
+USE_OCR_CACHE = True    # Reopening a page already OCR'd with the same model and settings doesn't run Tesseract again
+OCR_CACHE_PATH = 'ocr_cache.sqlite'  # next to GT_OUTPUT_DIR
+OCR_CACHE_MAX_BYTES = 64 * 1024 * 1024  # the least recently used pages are evicted beyond this size
+
+OCR_POLL_INTERVAL_MS = 50  # How often the GUI picks up the lines recognised by the background OCR
+
+REVIEW_CONFIDENCE_THRESHOLD = 80.0    # Lines and words under this OCR confidence are the ones to check
+REVIEW_AUTO_ACCEPT_CONFIDENCE = 95.0  # Lines at or above this confidence are auto-accepted in review mode
+
+LINE_IMAGE_CACHE_SIZE = 64      # Line crops kept in memory, the others are cropped again from the page when needed
+LINE_THUMBNAIL_CACHE_SIZE = 16  # Line thumbnails for TkVerifyWords (current, previous and next lines)
+
+PAGE_PREPROCESS_STEPS = []  # Applied to the page before the OCR, e.g. ['deskew', 'sauvola'] (see PREPROCESS_STEPS)
+LINE_PREPROCESS_STEPS = []  # Applied to every line before saving, e.g. ['trim', 'normalize_height']
+PREPROCESS_CACHE_SIZE = 4   # Preprocessed pages kept in memory
+SAUVOLA_WINDOW = 25
+SAUVOLA_K = 0.2
+DESKEW_MAX_ANGLE = 5.0  # degrees
+DESKEW_STEP = 0.2       # degrees
+TRIM_MARGIN = 4         # pixels left around the ink when trimming the borders
+LINE_TARGET_HEIGHT = 48  # pixels, for 'normalize_height'
+
+DISPLAY_MAX_SIZE = (1000, 700)  # The image is first shown fitted into this size
+DISPLAY_TILE_SIZE = 256         # Side of the tiles the zoomable image is rendered in
+DISPLAY_TILE_CACHE_SIZE = 96    # Rendered tiles kept in memory (all zoom levels)
+DISPLAY_MAX_ZOOM = 4.0          # Maximum zoom (display pixels per original pixel)
+DISPLAY_ZOOM_STEP = 1.25
+BOX_HANDLE_SIZE = 6             # Display pixels from a box border where pressing the mouse resizes the box
+EDIT_HISTORY_SIZE = 200         # Box edits that can be undone
+
+SESSION_JOURNAL_DIR = '.sessions'    # Journals of the unsaved GUI sessions, one per image
+SESSION_JOURNAL_COMPACT_EVERY = 500  # Entries appended before the journal is rewritten with only the current lines
+
+BENCHMARK_FIXTURES = ['images/iuvenalis-satura-viii-10-39.jpg']  # Pages whose reference lines are in GT_OUTPUT_DIR
+BENCHMARK_LANGUAGE = 'lat'  # Model in TESSDATA_FOLDER used by the benchmark
+BENCHMARK_VARIANTS = ('original', 'upscale2x', 'tile2x2')  # Upscaled and tiled copies stress large inputs
+BENCHMARK_BASELINE = 'benchmark_baseline.json'
+BENCHMARK_TOLERANCE = 0.20  # A run this much slower than the baseline is a regression
+BENCHMARK_CER_TOLERANCE = 0.005  # Allowed increase of the character error rate
 
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.max_rows', 500)
 
-GLOBAL_LINE_DATA = []  # CGlobal variables for data passing between Tkinter classes into dictionaries { 'image': PIL_Image, 'text': 'string', 'bbox': {...}, 'line_num': int }
+GLOBAL_LINE_DATA = []  # CGlobal variables for data passing between Tkinter classes: LineRecord objects, read like dictionaries { 'image': PIL_Image, 'text': 'string', 'bbox': {...}, 'line_num': int } (+ 'confidence', 'baseline', 'word_confidences')
+
+
+class _Span:
+    __slots__ = ('instrumentation', 'name', 'start')
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_span(self.name, perf_counter() - self.start)
+        return False
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Instrumentation:
+    """
+    Timings and counters of the pipeline, switched on with --instrument (see INSTRUMENTS).
+    span(name) times a block (count, total and maximum time per name) and count(name, n) adds to a counter:
+    while disabled both cost a single attribute check. profile() captures a cProfile of a block (the OCR)
+    when --cprofile is given. dump() writes everything as JSON and CSV at the end of the run.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.profiling = False
+        self.spans = {}  # name -> [count, total seconds, max seconds]
+        self.counters = Counter()
+        self.caches = {}  # name -> LRUCache, whose hits and misses are reported
+        self.profile_stats = None
+        self.start_time = perf_counter()
+        self._lock = threading.Lock()
+        self._profile_lock = threading.Lock()
+
+    def enable(self, profiling=False):
+        self.enabled = True
+        self.profiling = profiling
+        self.start_time = perf_counter()
+
+    def span(self, name):
+        return _Span(self, name) if self.enabled else _NO_SPAN
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            entry = self.spans.get(name)
+            if entry is None:
+                self.spans[name] = [1, seconds, seconds]
+            else:
+                entry[0] += 1
+                entry[1] += seconds
+                entry[2] = max(entry[2], seconds)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += n
+
+    def take(self):
+        """
+        Returns and clears the spans and counters recorded so far (used by the --batch worker processes).
+        """
+        with self._lock:
+            spans, counters = self.spans, self.counters
+            self.spans, self.counters = {}, Counter()
+        return spans, counters
+
+    def merge(self, spans, counters):
+        with self._lock:
+            for name, (count, total, longest) in spans.items():
+                entry = self.spans.setdefault(name, [0, 0.0, 0.0])
+                entry[0] += count
+                entry[1] += total
+                entry[2] = max(entry[2], longest)
+            self.counters.update(counters)
+
+    def watch_cache(self, name, cache):
+        if self.enabled:
+            self.caches[name] = cache
+
+    @contextmanager
+    def profile(self):
+        # cProfile sees only the thread that enables it, and only one profiler can be active at a time:
+        # a block started while another one is being profiled is not profiled
+        if not self.profiling or not self._profile_lock.acquire(blocking=False):
+            yield
+            return
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+            with self._lock:
+                if self.profile_stats is None:
+                    self.profile_stats = pstats.Stats(profiler)
+                else:
+                    self.profile_stats.add(profiler)
+        finally:
+            self._profile_lock.release()
+
+    def report(self):
+        with self._lock:
+            spans = {name: {'count': count, 'total_ms': total * 1000, 'mean_ms': total / count * 1000,
+                            'max_ms': longest * 1000}
+                     for name, (count, total, longest) in sorted(self.spans.items())}
+            counters = dict(sorted(self.counters.items()))
+        for name, cache in sorted(self.caches.items()):
+            counters[f"{name}.hits"] = cache.hits
+            counters[f"{name}.misses"] = cache.misses
+
+        derived = {}
+        for span, lines, key in (('ocr.page', 'ocr.lines', 'ocr'), ('gt.save', 'gt.lines_written', 'gt')):
+            seconds = spans.get(span, {}).get('total_ms', 0) / 1000
+            if seconds > 0 and counters.get(lines):
+                derived[f"{key}.lines_per_second"] = counters[lines] / seconds
+                derived[f"{key}.ms_per_line"] = seconds * 1000 / counters[lines]
+        seconds = spans.get('gt.save', {}).get('total_ms', 0) / 1000
+        if seconds > 0 and counters.get('gt.bytes_written'):
+            derived['gt.bytes_per_second'] = counters['gt.bytes_written'] / seconds
+        return {'runtime_id': RUNTIME_ID, 'wall_seconds': perf_counter() - self.start_time, 'spans': spans,
+                'counters': counters, 'derived': derived}
+
+    def dump(self, path):
+        """
+        Writes <path>.json and <path>.csv (and <path>.prof with the cProfile stats, if any).
+        """
+        base = os.path.splitext(path)[0] if path.lower().endswith(('.json', '.csv')) else path
+        report = self.report()
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+        rows = [{'kind': 'span', 'name': name, **values} for name, values in report['spans'].items()]
+        rows += [{'kind': 'counter', 'name': name, 'value': value} for name, value in report['counters'].items()]
+        rows += [{'kind': 'derived', 'name': name, 'value': value} for name, value in report['derived'].items()]
+        pd.DataFrame(rows, columns=['kind', 'name', 'count', 'total_ms', 'mean_ms', 'max_ms', 'value']).to_csv(
+            f"{base}.csv", index=False)
+
+        print(f"Instrumentation written to {base}.json and {base}.csv")
+        for name, values in report['spans'].items():
+            print(f"  {name:<24}{values['count']:>7} x {values['mean_ms']:9.1f} ms = {values['total_ms']:10.1f} ms")
+        for name, value in report['derived'].items():
+            print(f"  {name:<24}{value:12.1f}")
+
+        if self.profile_stats is not None:
+            self.profile_stats.dump_stats(f"{base}.prof")
+            print(f"cProfile of the OCR written to {base}.prof, top functions by cumulative time:")
+            self.profile_stats.sort_stats('cumulative').print_stats(15)
+
+
+INSTRUMENTS = Instrumentation()
+
+
+class LRUCache:
+    """
+    Small thread-safe least-recently-used cache with a maximum number of entries.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+LINE_IMAGE_CACHE = LRUCache(LINE_IMAGE_CACHE_SIZE)
+LINE_THUMBNAIL_CACHE = LRUCache(LINE_THUMBNAIL_CACHE_SIZE)
+INSTRUMENTS.caches.update(line_image_cache=LINE_IMAGE_CACHE, line_thumbnail_cache=LINE_THUMBNAIL_CACHE)
+
+
+class LineRecord:
+    """
+    A line of a page: bbox (ints, original image coordinates), text, number and OCR confidences.
+    The line image is not kept: it is cropped from the shared page image only when needed, and the
+    last crops and thumbnails are kept in LINE_IMAGE_CACHE / LINE_THUMBNAIL_CACHE.
+    It can be read and written like the old line dictionaries: line['text'], line['bbox'], line['image']...
+    """
+
+    __slots__ = ('uid', 'source', 'x', 'y', 'w', 'h', 'text', 'line_num', 'confidence', 'baseline',
+                 'word_confidences', '_image')
+
+    _uids = itertools.count()
+    _KEYS = ('image', 'text', 'bbox', 'line_num', 'confidence', 'baseline', 'word_confidences')
+
+    def __init__(self, source, bbox, text, line_num, confidence=None, baseline=None, word_confidences=None,
+                 image=None):
+        self.uid = next(LineRecord._uids)  # Cache key, unique for the whole run
+        self.source = source
+        self.x, self.y, self.w, self.h = (int(bbox[k]) for k in ('x', 'y', 'w', 'h'))
+        self.text = text
+        self.line_num = line_num
+        self.confidence = confidence
+        self.baseline = baseline
+        self.word_confidences = word_confidences  # [(word, confidence), ...] as recognised by the OCR
+        self._image = image  # Only for lines that don't come from source
+
+    @property
+    def bbox(self):
+        return {'x': self.x, 'y': self.y, 'w': self.w, 'h': self.h}
+
+    @bbox.setter
+    def bbox(self, bbox):
+        self.x, self.y, self.w, self.h = (int(bbox[k]) for k in ('x', 'y', 'w', 'h'))
+
+    def _cache_key(self):
+        return self.uid, self.x, self.y, self.w, self.h
+
+    @property
+    def image(self):
+        if self._image is not None:
+            return self._image
+        key = self._cache_key()
+        image = LINE_IMAGE_CACHE.get(key)
+        if image is None:
+            image = self.source.crop((self.x, self.y, self.x + self.w, self.y + self.h))
+            LINE_IMAGE_CACHE.put(key, image)
+        return image
+
+    @image.setter
+    def image(self, image):
+        self._image = image
+
+    def thumbnail(self, maxsize):
+        key = self._cache_key() + tuple(maxsize)
+        thumb = LINE_THUMBNAIL_CACHE.get(key)
+        if thumb is None:
+            thumb = self.image.copy()
+            thumb.thumbnail(maxsize, Image.LANCZOS)
+            LINE_THUMBNAIL_CACHE.put(key, thumb)
+        return thumb
+
+    def __getitem__(self, key):
+        if key not in LineRecord._KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in LineRecord._KEYS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in LineRecord._KEYS and getattr(self, key) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in LineRecord._KEYS else None
+        return default if value is None else value
+
+
+class TesseractEnginePool:
+    """
+    Keeps initialised PyTessBaseAPI engines per (tessdata path, language, OEM, PSM), so that the traineddata
+    is loaded only once and reused across pages and manually drawn boxes.
+    A PyTessBaseAPI can't be used by two threads at the same time: engine() checks out an idle one and
+    loads another only when all the engines for that key are busy (e.g. page OCR running in background).
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    @contextmanager
+    def engine(self, lang, path=None, oem=OEM.DEFAULT, psm=PSM.AUTO):
+        key = (os.path.abspath(path or TESSDATA_FOLDER), lang, oem, psm)
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            api = idle.pop() if idle else None
+        if api is None:
+            with INSTRUMENTS.span('ocr.model_load'):
+                api = tesserocr.PyTessBaseAPI(path=key[0], lang=lang, oem=oem, psm=psm)
+
+        try:
+            yield api
+        finally:
+            with self._lock:
+                if not self._closed:
+                    self._idle[key].append(api)
+                    api = None
+            if api is not None:
+                api.End()
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+            engines = [api for idle in self._idle.values() for api in idle]
+            self._idle.clear()
+        for api in engines:
+            api.End()
+
+
+ENGINE_POOL = TesseractEnginePool()
+atexit.register(ENGINE_POOL.shutdown)
 
 
-def save_gt_files(line_data, base_filename, output_dir=GT_OUTPUT_DIR):
+def image_sha256(image_pil):
+    digest = hashlib.sha256(f"{image_pil.mode}{image_pil.size}".encode())
+    digest.update(image_pil.tobytes())
+    return digest.hexdigest()
+
+
+class GtManifest:
+    """
+    SQLite manifest of a GT folder: one row per saved line, with the source image hash, line number, bbox,
+    text, confidence, image size and the checksums of the .tif and .gt.txt files.
+    save_gt_files updates it in a single transaction per page; the query helpers answer questions about
+    the corpus without looking at every file.
+    """
+
+    COLUMNS = ('name', 'source', 'source_hash', 'line_num', 'x', 'y', 'w', 'h', 'text', 'confidence',
+               'width', 'height', 'line_hash', 'tif_sha256', 'gt_sha256', 'updated')
+
+    def __init__(self, gt_dir=GT_OUTPUT_DIR):
+        self.gt_dir = gt_dir
+        self.path = os.path.join(gt_dir, GT_MANIFEST)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS gt_lines ("
+                     "name TEXT PRIMARY KEY, source TEXT, source_hash TEXT, line_num INTEGER, "
+                     "x INTEGER, y INTEGER, w INTEGER, h INTEGER, text TEXT, confidence REAL, "
+                     "width INTEGER, height INTEGER, line_hash TEXT, tif_sha256 TEXT, gt_sha256 TEXT, updated REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS gt_lines_source ON gt_lines (source)")
+        return conn
+
+    def line_hashes(self, source):
+        with self._connect() as conn:
+            return dict(conn.execute("SELECT name, line_hash FROM gt_lines WHERE source = ?", (source,)))
+
+    def upsert(self, rows):
+        if not rows:
+            return
+        placeholders = ', '.join('?' * len(self.COLUMNS))
+        with self._connect() as conn:  # One transaction: either all the rows of the page or none
+            conn.executemany(f"INSERT OR REPLACE INTO gt_lines ({', '.join(self.COLUMNS)}) VALUES ({placeholders})",
+                             [tuple(row[column] for column in self.COLUMNS) for row in rows])
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def names(self):
+        with self._connect() as conn:
+            return [name for name, in conn.execute("SELECT name FROM gt_lines ORDER BY name")]
+
+    def lines(self):
+        """
+        (name, text, gt_sha256, updated) of every saved line: what the later stages need, without opening the files.
+        """
+        with self._connect() as conn:
+            return conn.execute("SELECT name, text, gt_sha256, updated FROM gt_lines ORDER BY name").fetchall()
+
+    def to_dataframe(self):
+        with self._connect() as conn:
+            return pd.read_sql_query("SELECT * FROM gt_lines ORDER BY name", conn)
+
+    def orphans(self):
+        """
+        Compares the manifest with a single listing of the folder (and the shard index, if any).
+        Returns (files without a row or without their pair, rows whose .tif or .gt.txt is missing).
+        """
+        with os.scandir(self.gt_dir) as entries:
+            files = {entry.name for entry in entries if entry.is_file()}
+        names = set(self.names())
+        sharded = set()
+        if os.path.exists(os.path.join(self.gt_dir, GtShardStore.INDEX)):
+            sharded = set(GtShardStore(self.gt_dir).names())  # No files until they are exported
+        stray_files = sorted(name for name in files if (name.endswith('.tif') and name[:-4] not in names)
+                             or (name.endswith('.gt.txt') and name[:-7] not in names))
+        missing = sorted(name for name in names - sharded
+                         if f"{name}.tif" not in files or f"{name}.gt.txt" not in files)
+        return stray_files, missing
+
+    def source_stats(self):
+        """
+        Lines, characters and confidences per source image, as a pandas DataFrame.
+        """
+        with self._connect() as conn:
+            return pd.read_sql_query(
+                "SELECT source, source_hash, COUNT(*) AS lines, SUM(LENGTH(text)) AS chars, "
+                "AVG(confidence) AS mean_confidence, MIN(confidence) AS min_confidence, MAX(updated) AS updated "
+                "FROM gt_lines GROUP BY source, source_hash ORDER BY source", conn)
+
+    def train_eval_split(self, eval_ratio=LSTMF_EVAL_RATIO, by_source=False):
+        """
+        Deterministic (train names, eval names) split, the same one generate_lstmf_files uses.
+        With by_source all the lines of a source image end up on the same side.
+        """
+        with self._connect() as conn:
+            rows = conn.execute("SELECT name, source FROM gt_lines ORDER BY name").fetchall()
+        train, evaluation = [], []
+        for name, source in rows:
+            (evaluation if is_eval_line(source if by_source else name, eval_ratio) else train).append(name)
+        return train, evaluation
+
+
+def _file_equals(path, data):
+    try:
+        if os.path.getsize(path) != len(data):
+            return False
+        with open(path, 'rb') as f:
+            return f.read() == data
+    except FileNotFoundError:
+        return False
+
+
+class GtShardStore:
+    """
+    Packs GT lines into append-only tar shards (a line = its .tif and .gt.txt members) instead of
+    two small files per line. Shards grow up to GT_SHARD_MAX_BYTES each and are reused across runs; a writer
+    holds <shard>.lock while appending, so concurrent processes append to different shards. The offsets of the
+    members are kept in shards.sqlite, so any line can be read back by name through mmap.
+    A line saved again is appended again and the index points to the newest copy.
+    """
+
+    INDEX = 'shards.sqlite'
+
+    def __init__(self, gt_dir, max_bytes=GT_SHARD_MAX_BYTES):
+        self.gt_dir = gt_dir
+        self.max_bytes = max_bytes
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(os.path.join(self.gt_dir, self.INDEX), timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS members (name TEXT PRIMARY KEY, shard TEXT, "
+                     "tif_offset INTEGER, tif_size INTEGER, gt_offset INTEGER, gt_size INTEGER)")
+        return conn
+
+    def _acquire_shard(self):
+        """
+        Locks the first shard that isn't full nor locked by another writer, the indexed ones first (a new one
+        if all are). A lock left by a crashed writer only retires its shard, which may end with a partial member.
+        """
+        with self._connect() as conn:
+            indexed = [shard for shard, in conn.execute("SELECT DISTINCT shard FROM members ORDER BY shard")]
+        for shard in itertools.chain(indexed, (f"gt-{num:05d}.tar" for num in itertools.count())):
+            path = os.path.join(self.gt_dir, shard)
+            if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+                continue
+            try:
+                os.close(os.open(path + '.lock', os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:  # Filled before we locked it
+                os.remove(path + '.lock')
+                continue
+            return shard, path
+
+    def append(self, lines):
+        """
+        Appends lines, a list of (name, tif bytes, gt.txt bytes), and indexes them in one transaction.
+        """
+        rows = []
+        with self._lock:
+            shard, path = self._acquire_shard()
+            try:
+                with tarfile.open(path, 'a', format=tarfile.USTAR_FORMAT) as tar:
+                    for name, tif_bytes, gt_bytes in lines:
+                        offsets = []
+                        for suffix, data in (('.tif', tif_bytes), ('.gt.txt', gt_bytes)):
+                            info = tarfile.TarInfo(name + suffix)
+                            info.size = len(data)
+                            info.mtime = int(time())
+                            tar.addfile(info, io.BytesIO(data))
+                            # After addfile, tar.offset is the end of the data, padded to a 512 bytes block
+                            offsets.append(tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE)
+                        rows.append((name, shard, offsets[0], len(tif_bytes), offsets[1], len(gt_bytes)))
+                self._maps.pop(shard, None)  # The shard grew: map it again on the next read
+                with self._connect() as conn:
+                    conn.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?)", rows)
+            finally:
+                os.remove(path + '.lock')
+
+    def names(self):
+        with self._connect() as conn:
+            return [name for name, in conn.execute("SELECT name FROM members ORDER BY name")]
+
+    def __contains__(self, name):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM members WHERE name = ?", (name,)).fetchone() is not None
+
+    def _map(self, shard):
+        with self._lock:
+            if shard not in self._maps:
+                with open(os.path.join(self.gt_dir, shard), 'rb') as f:
+                    self._maps[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._maps[shard]
+
+    def read(self, name):
+        """
+        Returns (tif bytes, text) of a line, read from its shard through mmap.
+        """
+        with self._connect() as conn:
+            row = conn.execute("SELECT shard, tif_offset, tif_size, gt_offset, gt_size FROM members WHERE name = ?",
+                               (name,)).fetchone()
+        if row is None:
+            raise KeyError(name)
+        shard, tif_offset, tif_size, gt_offset, gt_size = row
+        data = self._map(shard)
+        if max(tif_offset + tif_size, gt_offset + gt_size) > len(data):
+            with self._lock:  # Another process appended to the shard since it was mapped
+                self._maps.pop(shard).close()
+            data = self._map(shard)
+        return data[tif_offset:tif_offset + tif_size], data[gt_offset:gt_offset + gt_size].decode('utf-8')
+
+    def read_image(self, name):
+        tif_bytes, text = self.read(name)
+        return Image.open(io.BytesIO(tif_bytes)), text
+
+    def export(self, output_dir=None, names=None):
+        """
+        Expands the lines (all, or the given names) into the standard .tif/.gt.txt layout of output_dir,
+        rewriting only the pairs whose bytes differ. Returns the number of lines written.
+        """
+        output_dir = output_dir or self.gt_dir
+        os.makedirs(output_dir, exist_ok=True)
+        written = 0
+        for name in (names if names is not None else self.names()):
+            tif_bytes, text = self.read(name)
+            tif_path = os.path.join(output_dir, f"{name}.tif")
+            gt_txt_path = os.path.join(output_dir, f"{name}.gt.txt")
+            gt_bytes = text.encode('utf-8')
+            if _file_equals(tif_path, tif_bytes) and _file_equals(gt_txt_path, gt_bytes):
+                continue  # An uncompressed .tif of the same size may still be another image: the bytes decide
+            _write_file_pair(tif_path, gt_txt_path, tif_bytes, gt_bytes)
+            written += 1
+        return written
+
+    def close(self):
+        with self._lock:
+            for data in self._maps.values():
+                data.close()
+            self._maps.clear()
+
+
+_SHARD_STORES = {}  # output folder -> GtShardStore of this process
+
+
+def shard_store(gt_dir):
+    gt_dir = os.path.abspath(gt_dir)
+    if gt_dir not in _SHARD_STORES:
+        _SHARD_STORES[gt_dir] = GtShardStore(gt_dir)
+    return _SHARD_STORES[gt_dir]
+
+
+def save_gt_files(line_data, base_filename, output_dir=GT_OUTPUT_DIR, compression=GT_TIFF_COMPRESSION, threads=None,
+                  output_format=None, page=None):
     """
     It saves the images of the cropped lines (.tif) and the texts (.gt.txt)
+    The files are encoded in a thread pool and written through temporary files renamed in place (the .gt.txt
+    last), so an interrupted save never leaves half-written files. Lines whose image and text didn't change
+    since the last save in output_dir are skipped. The saved lines are recorded in the folder's GtManifest.
     Args:
-        line_data (list): list of dictionaries containing 'image', 'text', 'bbox', 'line_num'.
+        line_data (list): list of LineRecord objects (or dictionaries) with 'image', 'text', 'bbox', 'line_num'.
         base_filename (str): base name of the original file (es. "documento").
         output_dir (str): directory to save files in.
+        compression (str): TIFF compression (see GT_TIFF_COMPRESSION).
+        threads (int): number of writer threads (default GT_WRITER_THREADS).
+        output_format (str): 'files' or 'shards' (default GT_OUTPUT_FORMAT).
+        page (int): page index in a multi-page document, added to the file names (es. "documento_p0003_l012").
     """
+    output_format = output_format or GT_OUTPUT_FORMAT
+    base_filename = page_basename(base_filename, page)
     full_output_path = os.path.join(os.getcwd(), output_dir)
     os.makedirs(full_output_path, exist_ok=True)
 
     print(f"Saving .gt.txt and .tif files to: {full_output_path}")
 
-    for data in line_data:
-        line_image = data['image']
-        line_text = data['text']
-        line_num = data['line_num']
+    source = getattr(line_data[0], 'source', None) if line_data else None
+    source_hash = image_sha256(source) if source is not None else None
+
+    manifest = GtManifest(full_output_path)
+    shards = shard_store(full_output_path) if output_format == 'shards' else None
+    writer = partial(_write_gt_pair, base_filename=base_filename, output_path=full_output_path,
+                     compression=compression, line_hashes=manifest.line_hashes(base_filename),
+                     source_hash=source_hash, shards=shards)
+    with INSTRUMENTS.span('gt.save'):
+        with ThreadPoolExecutor(max_workers=threads or GT_WRITER_THREADS) as pool:
+            results = list(pool.map(writer, line_data))
+
+    if shards is not None:
+        # The lines have been encoded in parallel, the shard is appended by one thread only
+        shards.append([(row['name'], tif_bytes, gt_bytes) for status, row, tif_bytes, gt_bytes in results
+                       if status == 'written'])
+    manifest.upsert([row for status, row, _, _ in results if status == 'written'])
+    statuses = [status for status, _, _, _ in results]
+    INSTRUMENTS.count('gt.lines_written', statuses.count('written'))
+    INSTRUMENTS.count('gt.lines_unchanged', statuses.count('unchanged'))
+    INSTRUMENTS.count('gt.bytes_written', sum(len(tif_bytes) + len(gt_bytes) for status, _, tif_bytes, gt_bytes
+                                              in results if status == 'written'))
+    print(f"{statuses.count('written')} lines written, {statuses.count('unchanged')} unchanged lines skipped"
+          + (f", {statuses.count('failed')} failed." if 'failed' in statuses else "."))
+
+
+def _write_file_pair(tif_path, gt_txt_path, tif_bytes, gt_bytes):
+    tmp_suffix = f".tmp{RUNTIME_ID}"
+    try:
+        with open(tif_path + tmp_suffix, 'wb') as f:
+            f.write(tif_bytes)
+        with open(gt_txt_path + tmp_suffix, 'wb') as f:
+            f.write(gt_bytes)
+
+        # The old .gt.txt goes first: until the new one is in place the line is an unpaired .tif, which the later
+        # stages skip, never a new image with the old text
+        try:
+            os.remove(gt_txt_path)
+        except FileNotFoundError:
+            pass
+        os.replace(tif_path + tmp_suffix, tif_path)
+        os.replace(gt_txt_path + tmp_suffix, gt_txt_path)
+    finally:
+        for tmp_path in (tif_path + tmp_suffix, gt_txt_path + tmp_suffix):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+
+def _write_gt_pair(data, base_filename, output_path, compression, line_hashes, source_hash, shards=None):
+    line_image = data['image']
+    line_text = data['text']
+    line_num = data['line_num']
+
+    # Naming convention per Tesseract: basename_linenum.tif / .gt.txt (pagina rimossa)
+    gt_filename_base = f"{base_filename}_l{line_num:03d}"
+    tif_path = os.path.join(output_path, f"{gt_filename_base}.tif")
+    gt_txt_path = os.path.join(output_path, f"{gt_filename_base}.gt.txt")
+
+    try:
+        line_image = preprocess_line(line_image)
+        line_hash = hashlib.sha256(f"{line_image.mode}{line_image.size}{compression}".encode())
+        line_hash.update(line_image.tobytes())
+        line_hash.update(line_text.encode('utf-8'))
+        line_hash = line_hash.hexdigest()
+        if line_hashes.get(gt_filename_base) == line_hash:
+            if shards is not None and gt_filename_base in shards:
+                return 'unchanged', None, None, None
+            if shards is None and os.path.exists(tif_path) and os.path.exists(gt_txt_path):
+                return 'unchanged', None, None, None
+
+        with INSTRUMENTS.span('gt.encode_tiff'):
+            if compression == 'group4':
+                line_image = line_image.convert('1')
+            tif_bytes = io.BytesIO()
+            if compression:
+                line_image.save(tif_bytes, format="TIFF", compression=compression)
+            else:
+                line_image.save(tif_bytes, format="TIFF")
+            tif_bytes = tif_bytes.getvalue()
+        gt_bytes = line_text.encode('utf-8')
+
+        if shards is None:
+            with INSTRUMENTS.span('gt.write_files'):
+                _write_file_pair(tif_path, gt_txt_path, tif_bytes, gt_bytes)
+
+        bbox = data['bbox']
+        return 'written', {
+            'name': gt_filename_base, 'source': base_filename, 'source_hash': source_hash, 'line_num': line_num,
+            'x': bbox['x'], 'y': bbox['y'], 'w': bbox['w'], 'h': bbox['h'],
+            'text': line_text, 'confidence': data.get('confidence'),
+            'width': line_image.width, 'height': line_image.height, 'line_hash': line_hash,
+            'tif_sha256': hashlib.sha256(tif_bytes).hexdigest(), 'gt_sha256': hashlib.sha256(gt_bytes).hexdigest(),
+            'updated': time(),
+        }, tif_bytes, gt_bytes
+    except Exception as e:
+        print(f"Error saving files for line {line_num}: {e}")
+        return 'failed', None, None, None
+
+
+def extract_text_lines(image_pil, lang, api=None):
+    """
+    Extracts line-level OCR data from a page image.
+    Args:
+        image_pil (PIL.Image): page image to segment and recognise.
+        lang (str): Tesseract language label of the model.
+        api (tesserocr.PyTessBaseAPI): already initialised engine to use. If None, the one in ENGINE_POOL is used.
+    Returns:
+        list: LineRecord objects ('image', 'text', 'bbox', 'line_num', 'confidence', 'word_confidences').
+    """
+    return list(iter_text_lines(image_pil, lang, api=api))
+
+
+def iter_text_lines(image_pil, lang, api=None, cancel_event=None):
+    """
+    Same as extract_text_lines, but yields every line as soon as it has been recognised.
+    If cancel_event (threading.Event) is set, the extraction stops after the current line (in the OCR_SINGLE_PASS
+    mode, only once Tesseract has recognised the whole page).
+    Complete results are stored in OCR_CACHE, and a cached page is rebuilt without running Tesseract.
+    """
+    cache_key = ocr_cache_key(image_pil, lang) if USE_OCR_CACHE else None
+    if cache_key is not None:
+        cached_lines = OCR_CACHE.get(cache_key)
+        if cached_lines is not None:
+            print(f"OCR cache hit: {len(cached_lines)} lines")
+            INSTRUMENTS.count('ocr_cache.hits')
+            yield from lines_from_cache(image_pil, cached_lines)
+            return
+        INSTRUMENTS.count('ocr_cache.misses')
+
+    status = {}  # Filled by _ocr_text_lines: engine used and whether the page was read to the end
+    extracted_lines = []
+    with INSTRUMENTS.span('ocr.page'), INSTRUMENTS.profile():
+        for line in _ocr_text_lines(image_pil, lang, api, cancel_event, status):
+            extracted_lines.append(line)
+            yield line
+
+        if USE_MSER_TO_FIND_LEFTOVER_REGIONS and not (cancel_event is not None and cancel_event.is_set()):
+            for line in leftover_text_lines(image_pil, lang, extracted_lines, cancel_event):
+                extracted_lines.append(line)
+                yield line
+    INSTRUMENTS.count('ocr.pages')
+    INSTRUMENTS.count('ocr.lines', len(extracted_lines))
+
+    cancelled = cancel_event is not None and cancel_event.is_set()
+    if cache_key is not None and not cancelled and status.get('complete') and status.get('engine') == 'tesserocr':
+        OCR_CACHE.put(cache_key, extracted_lines)
+
+
+def _ocr_text_lines(image_pil, lang, api=None, cancel_event=None, status=None):
+    # status (dict), if given, receives 'engine' ('tesserocr' or 'pytesseract') and 'complete': True
+    # only when the whole page was read without errors or cancellation
+    n_lines = 0
+    status = {} if status is None else status
+    status['complete'] = False
 
-        # Naming convention per Tesseract: basename_linenum.tif / .gt.txt (pagina rimossa)
-        gt_filename_base = f"{base_filename}_l{line_num:03d}"
-        tif_path = os.path.join(full_output_path, f"{gt_filename_base}.tif")
-        gt_txt_path = os.path.join(full_output_path, f"{gt_filename_base}.gt.txt")
+    global USE_TESSEROCR  # Allows modification if tesserocr fails
 
+    if USE_TESSEROCR:
         try:
-            line_image.save(tif_path, format="TIFF")
-            with open(gt_txt_path, 'w', encoding='utf-8') as f:
-                f.write(line_text)
+            if api is None:
+                with ENGINE_POOL.engine(lang) as pooled_api:
+                    for line in _tesserocr_text_lines(pooled_api, image_pil, cancel_event):
+                        n_lines += 1
+                        yield line
+            else:
+                for line in _tesserocr_text_lines(api, image_pil, cancel_event):
+                    n_lines += 1
+                    yield line
+            status['engine'] = 'tesserocr'
+            status['complete'] = not (cancel_event is not None and cancel_event.is_set())
+            return
+        except Exception as e:
+            print(f"tesserocr OCR extraction failed: {e}")
+            if n_lines:
+                return  # Some lines have already been delivered, don't repeat them with pytesseract
+            print("Falling back to pytesseract...")
+            USE_TESSEROCR = False
+
+    if not USE_TESSEROCR:  # Fallback to pytesseract
+        try:
+            data = pytesseract.image_to_data(image_pil, lang=lang, output_type=pytesseract.Output.DICT)
         except Exception as e:
-            print(f"Error saving files for line {line_num}: {e}")
+            print(f"pytesseract OCR extraction failed: {e}")
+            print("OCR extraction failed completely. No lines will be processed.")
+            return
+
+        for i in range(len(data['level'])):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if data['level'][i] == 4:  # Level 4 is for TEXTLINE
+                x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
+                line_text = data['text'][i].strip()
+
+                if line_text:
+                    yield LineRecord(image_pil, {'x': x, 'y': y, 'w': w, 'h': h}, line_text, n_lines)
+                    n_lines += 1
+        status['engine'] = 'pytesseract'
+        status['complete'] = True
+
+
+def _tesserocr_text_lines(api, image_pil, cancel_event=None):
+    if OCR_SINGLE_PASS:
+        yield from _tesserocr_text_lines_single_pass(api, image_pil, cancel_event)
+        return
+
+    n_lines = 0
+    api.SetImage(image_pil)
+    with INSTRUMENTS.span('ocr.segmentation'):
+        components = api.GetComponentImages(RIL.TEXTLINE, True)
+
+    for i, (_, line_bbox, _, _) in enumerate(components):
+        if cancel_event is not None and cancel_event.is_set():
+            return
+        with INSTRUMENTS.span('ocr.line'):
+            api.SetRectangle(line_bbox['x'], line_bbox['y'], line_bbox['w'], line_bbox['h'])
+            text = api.GetUTF8Text().strip()
+            line = LineRecord(image_pil, line_bbox, text, n_lines, confidence=api.MeanTextConf(),
+                              word_confidences=list(zip(text.split(), api.AllWordConfidences()))) if text else None
+
+        if line is not None:
+            yield line
+            n_lines += 1
+
+
+def _tesserocr_text_lines_single_pass(api, image_pil, cancel_event=None):
+    # A single Recognize() for the whole page, then bbox, text, confidence and baseline of every
+    # TEXTLINE are read together from the result iterator (no layout analysis/recognition per line).
+    # The iterator walks the words, so that the confidence of every word is collected in the same pass.
+    # Recognize() does almost all the work and can't be interrupted: cancel_event is only checked once it
+    # returns, so a cancelled page yields no line (the per-line mode, OCR_SINGLE_PASS = False, stops between lines)
+    n_lines = 0
+    with INSTRUMENTS.span('ocr.recognize'):  # Segmentation and recognition of the whole page
+        api.SetImage(image_pil)
+        api.Recognize()
+
+    iterator = api.GetIterator()
+    if iterator is None:
+        return
+
+    line = None
+    for word in iterate_level(iterator, RIL.WORD):
+        if line is None or word.IsAtBeginningOf(RIL.TEXTLINE):
+            if line is not None and line.text:
+                yield line
+                n_lines += 1
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            x1, y1, x2, y2 = word.BoundingBox(RIL.TEXTLINE)
+            line = LineRecord(image_pil, {'x': x1, 'y': y1, 'w': x2 - x1, 'h': y2 - y1},
+                              (word.GetUTF8Text(RIL.TEXTLINE) or '').strip(), n_lines,
+                              confidence=word.Confidence(RIL.TEXTLINE), baseline=word.Baseline(RIL.TEXTLINE),
+                              word_confidences=[])
+
+        word_text = (word.GetUTF8Text(RIL.WORD) or '').strip()
+        if word_text:
+            line.word_confidences.append((word_text, word.Confidence(RIL.WORD)))
+
+    if line is not None and line.text:
+        yield line
+
+
+class OcrResultCache:
+    """
+    On-disk (SQLite) cache of the line bboxes, texts and confidences recognised on a page.
+    The total size is bounded: the least recently used pages are evicted first.
+    """
+
+    def __init__(self, path=OCR_CACHE_PATH, max_bytes=OCR_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # A connection per call: the cache is used from the GUI, the OCR thread and the batch processes
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS ocr_cache ("
+                     "key TEXT PRIMARY KEY, lines TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+        return conn
+
+    def get(self, key):
+        try:
+            with self._lock, self._connect() as conn:
+                row = conn.execute("SELECT lines FROM ocr_cache WHERE key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE ocr_cache SET last_used = ? WHERE key = ?", (time(), key))
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as e:
+            print(f"OCR cache read failed: {e}")
+            return None
+
+    def put(self, key, line_data):
+        lines = [{'bbox': {k: int(v) for k, v in data['bbox'].items()},
+                  'text': data['text'],
+                  'confidence': data.get('confidence'),
+                  'word_confidences': data.get('word_confidences'),
+                  'baseline': data.get('baseline')} for data in line_data]
+        payload = json.dumps(lines, ensure_ascii=False)
+        try:
+            with self._lock, self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO ocr_cache (key, lines, size, last_used) VALUES (?, ?, ?, ?)",
+                             (key, payload, len(payload.encode('utf-8')), time()))
+                self._evict(conn)
+        except sqlite3.Error as e:
+            print(f"OCR cache write failed: {e}")
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM ocr_cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in conn.execute("SELECT key, size FROM ocr_cache ORDER BY last_used ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM ocr_cache WHERE key = ?", evicted)
+
+
+OCR_CACHE = OcrResultCache()
+
+_MODEL_HASHES = {}  # (path, mtime, size) -> sha256, so that the traineddata is hashed only once per run
+
+
+def _file_sha256(path):
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_mtime, stat.st_size)
+    if memo_key not in _MODEL_HASHES:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(partial(f.read, 1024 * 1024), b''):
+                digest.update(chunk)
+        _MODEL_HASHES[memo_key] = digest.hexdigest()
+    return _MODEL_HASHES[memo_key]
+
+
+def ocr_cache_key(image_pil, lang, oem=OEM.DEFAULT, psm=PSM.AUTO):
+    """
+    Cache key of a page: image pixels SHA-256, language, traineddata SHA-256, OEM/PSM and extraction mode.
+    """
+    model_hashes = []
+    for model in lang.split('+'):
+        model_path = os.path.join(TESSDATA_FOLDER, f"{model}.traineddata")
+        model_hashes.append(_file_sha256(model_path) if os.path.exists(model_path) else 'missing')
+
+    if USE_TESSEROCR:
+        engine = 'tesserocr-single-pass' if OCR_SINGLE_PASS else 'tesserocr-per-line'
+    else:
+        engine = 'pytesseract'
+    if USE_MSER_TO_FIND_LEFTOVER_REGIONS:
+        engine += f'+leftovers{LEFTOVER_OCR_REGION_PADDING}'
+    return '|'.join([image_sha256(image_pil), lang, ','.join(model_hashes), str(int(oem)), str(int(psm)), engine])
+
+
+def lines_from_cache(image_pil, cached_lines):
+    """
+    Rebuilds the line data of a cached page: the line images will be cropped from the page image.
+    """
+    line_data = []
+    for line_num, cached in enumerate(cached_lines):
+        baseline = cached.get('baseline')
+        if baseline is not None:
+            baseline = tuple(tuple(point) for point in baseline)
+        word_confidences = cached.get('word_confidences')
+        if word_confidences is not None:
+            word_confidences = [tuple(word) for word in word_confidences]
+        line_data.append(LineRecord(image_pil, cached['bbox'], cached['text'], line_num,
+                                    confidence=cached.get('confidence'), baseline=baseline,
+                                    word_confidences=word_confidences))
+    return line_data
+
+
+def recognize_region(image_pil, lang):
+    """
+    Recognises the text of a single cropped region (e.g. a box drawn by hand).
+    """
+    if USE_TESSEROCR:
+        try:
+            with ENGINE_POOL.engine(lang) as api, INSTRUMENTS.span('ocr.region'):
+                api.SetImage(image_pil)
+                return api.GetUTF8Text().strip()
+        except Exception as e:
+            print(f"tesserocr region OCR failed: {e}")
+    return pytesseract.image_to_string(image_pil, lang=lang).strip()
+
+
+class LineBoxIndex:
+    """
+    Spatial index of the editable line boxes of a page, for hit-testing.
+    Boxes are kept sorted by their top (like LineIntervalIndex), so a point or a rectangle is compared only
+    with the boxes whose top is in a narrow band, and boxes can be inserted, moved and removed in place.
+    """
+
+    def __init__(self):
+        self.tops = []  # Sorted (y1, uid)
+        self.boxes = {}  # uid -> (x1, y1, x2, y2)
+        self.max_height = 0  # Never decreases: removing a box at most widens the searched band a little
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def insert(self, uid, x1, y1, x2, y2):
+        if uid in self.boxes:
+            self.remove(uid)
+        self.boxes[uid] = (x1, y1, x2, y2)
+        bisect.insort(self.tops, (y1, uid))
+        self.max_height = max(self.max_height, y2 - y1)
+
+    def remove(self, uid):
+        x1, y1, x2, y2 = self.boxes.pop(uid)
+        del self.tops[bisect.bisect_left(self.tops, (y1, uid))]
+
+    def overlapping(self, x1, y1, x2, y2):
+        """
+        uids of the boxes overlapping [x1, x2] x [y1, y2] (borders included).
+        """
+        start = bisect.bisect_left(self.tops, (y1 - self.max_height,))
+        stop = bisect.bisect_right(self.tops, (y2, float('inf')))
+        result = []
+        for _, uid in self.tops[start:stop]:
+            bx1, by1, bx2, by2 = self.boxes[uid]
+            if by2 >= y1 and bx1 <= x2 and bx2 >= x1:
+                result.append(uid)
+        return result
+
+    def at(self, x, y, margin=0):
+        """
+        uids of the boxes containing the point (within margin of their borders), smallest box first.
+        """
+        hits = self.overlapping(x - margin, y - margin, x + margin, y + margin)
+        return sorted(hits, key=lambda uid: (self.boxes[uid][2] - self.boxes[uid][0]) *
+                                            (self.boxes[uid][3] - self.boxes[uid][1]))
+
+
+class ImagePyramid:
+    """
+    Image pyramid of a page: level 0 is the original image, every next level is half the size of the previous one.
+    Any region of the page can be rendered at any zoom from the smallest level that is still detailed enough,
+    so the cost of a tile doesn't depend on the size of the source image.
+    """
+
+    def __init__(self, image, min_side=DISPLAY_TILE_SIZE):
+        self.width, self.height = image.size
+        self.levels = [image]
+        while min(self.levels[-1].size) // 2 >= min_side:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    def display_size(self, zoom):
+        return max(1, int(round(self.width * zoom))), max(1, int(round(self.height * zoom)))
+
+    def level_for(self, zoom):
+        for level in reversed(range(len(self.levels))):
+            if self.levels[level].width / self.width >= zoom:
+                return level
+        return 0
+
+    def render(self, zoom, box):
+        """
+        Renders box (x1, y1, x2, y2, in display coordinates at the given zoom) as a PIL image.
+        """
+        x1, y1, x2, y2 = box
+        level = self.level_for(zoom)
+        source = self.levels[level]
+        ratio_x = source.width / self.width / zoom
+        ratio_y = source.height / self.height / zoom
+        source_box = (x1 * ratio_x, y1 * ratio_y,
+                      min(x2 * ratio_x, source.width), min(y2 * ratio_y, source.height))
+        return source.resize((x2 - x1, y2 - y1), Image.BILINEAR, box=source_box)
+
+
+# --- Preprocessing ---
+
+def to_grayscale(image_pil):
+    """
+    ITU-R 601 luma of an image as a uint8 array.
+    """
+    if image_pil.mode == 'L':
+        return np.asarray(image_pil)
+    rgb = np.asarray(image_pil.convert('RGB'), dtype=np.float32)
+    return (rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)).round().astype(np.uint8)
+
+
+def binarize_otsu(gray):
+    return np.where(gray > otsu_threshold(gray), 255, 0).astype(np.uint8)
+
+
+def binarize_sauvola(gray, window=SAUVOLA_WINDOW, k=SAUVOLA_K, r=128.0):
+    """
+    Sauvola's local threshold, with the local mean and deviation of every window taken from integral images.
+    """
+    half = window // 2
+    window = 2 * half + 1
+    padded = np.pad(gray.astype(np.float64), half, mode='reflect')
+    # A leading zero row and column: table[i, j] is the sum of padded[:i, :j], so windows are centred on (i, j)
+    integral = np.pad(padded.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    integral_sq = np.pad((padded ** 2).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+
+    def window_sums(table):
+        return table[window:, window:] - table[:-window, window:] - table[window:, :-window] + table[:-window, :-window]
+
+    area = window * window
+    mean = window_sums(integral) / area
+    variance = window_sums(integral_sq) / area - mean ** 2
+    threshold = mean * (1 + k * (np.sqrt(np.maximum(variance, 0)) / r - 1))
+    return np.where(gray > threshold, 255, 0).astype(np.uint8)
+
+
+def skew_angle(gray, max_angle=DESKEW_MAX_ANGLE, step=DESKEW_STEP):
+    """
+    Skew of the text in degrees, from projection profiles: the ink pixels are projected on the rows along every
+    candidate angle, and the sharpest profile (largest sum of squares) wins.
+    """
+    sample = max(1, max(gray.shape) // 1000)  # A ~1000 px sample is enough to measure the angle
+    small = gray[::sample, ::sample]
+    ys, xs = np.nonzero(small <= otsu_threshold(small))
+    if len(ys) == 0:
+        return 0.0
+    ys, xs = ys.astype(np.float64), xs.astype(np.float64)
+
+    best_angle, best_score = 0.0, -1.0
+    for angle in np.arange(-max_angle, max_angle + step / 2, step):
+        rows = np.round(ys - xs * np.tan(np.radians(angle))).astype(np.int64)
+        profile = np.bincount(rows - rows.min())
+        score = float(np.dot(profile, profile))
+        if score > best_score:
+            best_angle, best_score = float(angle), score
+    return best_angle
+
+
+def deskew(gray):
+    angle = skew_angle(gray)
+    if abs(angle) < DESKEW_STEP / 2:
+        return gray
+    rotated = Image.fromarray(gray).rotate(angle, resample=Image.BICUBIC, expand=True, fillcolor=255)
+    return np.asarray(rotated)
+
+
+def trim_borders(gray, margin=TRIM_MARGIN):
+    ink = gray <= otsu_threshold(gray)
+    rows, cols = np.flatnonzero(ink.any(axis=1)), np.flatnonzero(ink.any(axis=0))
+    if len(rows) == 0:
+        return gray
+    return gray[max(0, rows[0] - margin):rows[-1] + 1 + margin, max(0, cols[0] - margin):cols[-1] + 1 + margin]
+
+
+def normalize_height(gray, height=LINE_TARGET_HEIGHT):
+    if gray.shape[0] == height or gray.shape[0] == 0:
+        return gray
+    width = max(1, int(round(gray.shape[1] * height / gray.shape[0])))
+    return np.asarray(Image.fromarray(gray).resize((width, height), Image.LANCZOS))
+
+
+PREPROCESS_STEPS = {
+    'grayscale': lambda gray: gray,  # Every pipeline works on grayscale: this step only asks for the conversion
+    'otsu': binarize_otsu,
+    'sauvola': binarize_sauvola,
+    'deskew': deskew,
+    'trim': trim_borders,
+    'normalize_height': normalize_height,
+}
+
+
+class PreprocessPipeline:
+    """
+    A sequence of PREPROCESS_STEPS applied to an image (converted to grayscale first).
+    The time spent in every step is accumulated in `timings`, and results are cached per image content.
+    """
+
+    def __init__(self, steps, cache_size=PREPROCESS_CACHE_SIZE):
+        unknown = [step for step in steps if step not in PREPROCESS_STEPS]
+        if unknown:
+            raise ValueError(f"Unknown preprocessing steps: {', '.join(unknown)}")
+        self.steps = list(steps)
+        self.cache = LRUCache(cache_size) if cache_size else None
+        self.timings = Counter()
+
+    def run(self, image_pil):
+        if not self.steps:
+            return image_pil
+        key = None
+        if self.cache is not None:
+            key = image_sha256(image_pil)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        start = perf_counter()
+        array = to_grayscale(image_pil)
+        self.timings['grayscale'] += perf_counter() - start
+        for step in self.steps:
+            start = perf_counter()
+            array = PREPROCESS_STEPS[step](array)
+            elapsed = perf_counter() - start
+            self.timings[step] += elapsed
+            if INSTRUMENTS.enabled:
+                INSTRUMENTS.add_span(f"preprocess.{step}", elapsed)
+        result = Image.fromarray(array)
+
+        if key is not None:
+            self.cache.put(key, result)
+        return result
+
+    __call__ = run
+
+
+_PIPELINES = {}
+
+
+def _pipeline(steps, cache_size):
+    key = (tuple(steps), cache_size)
+    if key not in _PIPELINES:
+        _PIPELINES[key] = PreprocessPipeline(steps, cache_size)
+    return _PIPELINES[key]
+
+
+def preprocess_page(image_pil):
+    return _pipeline(PAGE_PREPROCESS_STEPS, PREPROCESS_CACHE_SIZE)(image_pil)
+
+
+def preprocess_line(image_pil):
+    return _pipeline(LINE_PREPROCESS_STEPS, 0)(image_pil)  # Lines are cropped once per save: no cache
+
+
+def benchmark_preprocessing(image_path, steps, repeat=3):
+    """
+    Times every preprocessing step on an image (without cache) and prints the mean time per step.
+    """
+    image = Image.open(image_path).convert("RGB")
+    pipeline = PreprocessPipeline(steps, cache_size=0)
+    start = perf_counter()
+    for _ in range(repeat):
+        result = pipeline(image)
+    total = perf_counter() - start
+    print(f"Preprocessing {os.path.basename(image_path)} {image.size} -> {result.size}, {repeat} runs:")
+    for step in ['grayscale'] + pipeline.steps:
+        print(f"  {step:<17}{pipeline.timings[step] / repeat * 1000:9.1f} ms")
+    print(f"  {'total':<17}{total / repeat * 1000:9.1f} ms")
+    return {step: seconds / repeat for step, seconds in pipeline.timings.items()}
+
+
+# --- Leftover regions (text missed by Tesseract's line segmentation) ---
+
+class LineIntervalIndex:
+    """
+    Line bboxes sorted by their top: the lines overlapping a box are found with a bisect instead of
+    comparing the box with every line.
+    """
+
+    def __init__(self, bboxes):
+        self.bboxes = sorted((b['y'], b['x'], b['y'] + b['h'], b['x'] + b['w']) for b in bboxes)
+        self.tops = [bbox[0] for bbox in self.bboxes]
+        self.max_height = max((y2 - y1 for y1, _, y2, _ in self.bboxes), default=0)
+
+    def overlapping(self, x1, y1, x2, y2):
+        # A line overlapping [y1, y2) starts before y2 and, being at most max_height tall, after y1 - max_height
+        start = bisect.bisect_right(self.tops, y1 - self.max_height)
+        stop = bisect.bisect_left(self.tops, y2)
+        return [(lx1, ly1, lx2, ly2) for ly1, lx1, ly2, lx2 in self.bboxes[start:stop]
+                if ly2 > y1 and lx1 < x2 and lx2 > x1]
+
+    def covered_fraction(self, x1, y1, x2, y2):
+        area = (x2 - x1) * (y2 - y1)
+        if area <= 0:
+            return 1.0
+        covered = np.zeros((y2 - y1, x2 - x1), dtype=bool)
+        for lx1, ly1, lx2, ly2 in self.overlapping(x1, y1, x2, y2):
+            covered[max(ly1, y1) - y1:min(ly2, y2) - y1, max(lx1, x1) - x1:min(lx2, x2) - x1] = True
+        return covered.mean()
+
+
+def otsu_threshold(gray):
+    """
+    Otsu's threshold of a uint8 grayscale array (ink is <= threshold), computed on its histogram.
+    """
+    hist = np.bincount(gray.ravel(), minlength=256).astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist)
+    weight_fg = weight_bg[-1] - weight_bg
+    sum_bg = np.cumsum(hist * levels)
+    mean_bg = sum_bg / np.maximum(weight_bg, 1)
+    mean_fg = (sum_bg[-1] - sum_bg) / np.maximum(weight_fg, 1)
+    between_variance = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return int(np.argmax(between_variance))
+
+
+def _true_runs(mask, max_gap=0):
+    """
+    (start, stop) of the runs of True in a 1-D boolean array, joining runs separated by at most max_gap False.
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], mask, [False])).astype(np.int8)))
+    starts, stops = edges[0::2], edges[1::2]
+    if len(starts) == 0:
+        return []
+    keep = np.concatenate(([True], starts[1:] - stops[:-1] > max_gap))
+    return list(zip(starts[keep], np.concatenate((stops[:-1][keep[1:]], stops[-1:]))))
+
+
+def _split_text_lines(profile, line_height):
+    """
+    (start, stop) of the text lines of a region from its row profile (ink pixels per row).
+    The rows over LEFTOVER_VALLEY_RATIO of the darkest rows are the cores (x-height) of the lines, and two
+    lines are cut at the lightest row between their cores, so that ascenders and descenders joining them
+    don't merge them. A line still taller than LEFTOVER_MAX_LINE_RATIO * line_height is cut again.
+    """
+    text_rows = profile[profile > 0]
+    if len(text_rows) == 0:
+        return []
+    cores = _true_runs(profile > LEFTOVER_VALLEY_RATIO * np.percentile(text_rows, 90), max_gap=1)
+    core_height = np.median([stop - start for start, stop in cores])
+    cores = [(int(start), int(stop)) for start, stop in cores if stop - start >= core_height / 2]
+
+    cuts = [0] + [previous_stop + int(np.argmin(profile[previous_stop:start]))
+                  for (_, previous_stop), (start, _) in zip(cores, cores[1:])] + [len(profile)]
+    lines = list(zip(cuts, cuts[1:]))
+    if not line_height:
+        line_height = np.median([stop - start for start, stop in lines])
+    line_height = max(1, int(line_height))
+
+    result = []
+    while lines:
+        start, stop = lines.pop()
+        if stop - start <= LEFTOVER_MAX_LINE_RATIO * line_height:
+            result.append((start, stop))
+            continue
+        # The cut is looked for at least half a line from both ends, and is always strictly inside the line
+        half = max(1, line_height // 2)
+        low, high = start + half, stop - half
+        cut = low + int(np.argmin(profile[low:high])) if high > low else (start + stop) // 2
+        lines += [(start, cut), (cut, stop)]
+    return sorted(result)
+
+
+def find_leftover_regions(image_pil, line_data, padding=LEFTOVER_OCR_REGION_PADDING):
+    """
+    Finds the ink of the page not covered by any line bbox and groups it into padded candidate line bboxes.
+    The ink is found on a block-downsampled Otsu binarisation; blocks are grouped into bands of rows
+    and then into runs of columns (a gap wider than the band height separates two regions). Every region
+    is then split into text lines on the valleys of its row profile (see _split_text_lines).
+    """
+    gray = np.asarray(image_pil.convert('L'))
+    ink = gray <= otsu_threshold(gray)
+
+    # Ink already inside a line (or just around it) doesn't count
+    margin = padding // 2
+    for data in line_data:
+        b = data['bbox']
+        ink[max(0, b['y'] - margin):b['y'] + b['h'] + margin, max(0, b['x'] - margin):b['x'] + b['w'] + margin] = False
+
+    block = LEFTOVER_BLOCK_SIZE
+    height, width = (ink.shape[0] // block) * block, (ink.shape[1] // block) * block
+    blocks = ink[:height, :width].reshape(height // block, block, width // block, block).sum(axis=(1, 3))
+    blocks = blocks >= LEFTOVER_MIN_BLOCK_INK
+
+    index = LineIntervalIndex([data['bbox'] for data in line_data])
+    line_height = np.median([data['bbox']['h'] for data in line_data]) if line_data else None
+    regions = []
+    for row_start, row_stop in _true_runs(blocks.any(axis=1), max_gap=1):
+        band = blocks[row_start:row_stop]
+        for col_start, col_stop in _true_runs(band.any(axis=0), max_gap=max(2, row_stop - row_start)):
+            rows = np.flatnonzero(band[:, col_start:col_stop].any(axis=1))
+            x1, x2 = int(col_start) * block, int(col_stop) * block
+            region_y1, region_y2 = int(row_start + rows[0]) * block, int(row_start + rows[-1] + 1) * block
+            profile = ink[region_y1:region_y2, x1:x2].sum(axis=1)
+            for line_start, line_stop in _split_text_lines(profile, line_height):
+                y1, y2 = region_y1 + line_start, region_y1 + line_stop
+                if x2 - x1 < LEFTOVER_MIN_REGION_SIZE or y2 - y1 < LEFTOVER_MIN_REGION_SIZE:
+                    continue
+                if index.covered_fraction(x1, y1, x2, y2) > LEFTOVER_MAX_COVERED:
+                    continue
+                # Lines are padded less vertically, not to take in the neighbouring lines
+                pad_y = min(padding, max(1, (y2 - y1) // 4))
+                line_x1, line_y1 = max(0, x1 - padding), max(0, y1 - pad_y)
+                line_x2, line_y2 = min(image_pil.width, x2 + padding), min(image_pil.height, y2 + pad_y)
+                regions.append({'x': line_x1, 'y': line_y1, 'w': line_x2 - line_x1, 'h': line_y2 - line_y1})
+    return regions
+
+
+def recognize_regions(image_pil, bboxes, lang):
+    """
+    Recognises many regions of the same page with one engine and a single SetImage.
+    Returns a list of (text, confidence) in the same order as bboxes.
+    """
+    if USE_TESSEROCR:
+        try:
+            results = []
+            with ENGINE_POOL.engine(lang) as api:
+                api.SetImage(image_pil)
+                for b in bboxes:
+                    api.SetRectangle(b['x'], b['y'], b['w'], b['h'])
+                    results.append((api.GetUTF8Text().strip(), api.MeanTextConf()))
+            return results
+        except Exception as e:
+            print(f"tesserocr region OCR failed: {e}")
+    return [(pytesseract.image_to_string(image_pil.crop((b['x'], b['y'], b['x'] + b['w'], b['y'] + b['h'])),
+                                         lang=lang).strip(), None) for b in bboxes]
+
+
+def leftover_text_lines(image_pil, lang, line_data, cancel_event=None):
+    """
+    Yields LineRecord objects for the text found in the leftover regions, numbered after line_data.
+    """
+    with INSTRUMENTS.span('ocr.leftover_regions'):
+        regions = find_leftover_regions(image_pil, line_data)
+    if not regions or (cancel_event is not None and cancel_event.is_set()):
+        return
+    print(f"OCR of {len(regions)} leftover regions...")
+
+    n_lines = len(line_data)
+    for bbox, (text, confidence) in zip(regions, recognize_regions(image_pil, regions, lang)):
+        if text and '\n' not in text:  # A candidate read as many lines is not a valid GT line
+            yield LineRecord(image_pil, bbox, text, n_lines, confidence=confidence)
+            n_lines += 1
+
+
+# --- Input documents (images, multi-page TIFFs, PDFs) ---
+
+def page_basename(base_filename, page):
+    return base_filename if page is None else f"{base_filename}_p{page + 1:04d}"
+
+
+class PageDocument:
+    """
+    An input file as a sequence of pages. Pages are decoded one at a time when asked for, so a long
+    multi-page TIFF or PDF is never loaded whole: TIFF frames are read with seek(), PDF pages are rendered
+    one by one by pdf2image (Poppler) at PDF_DPI.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.is_pdf = path.lower().endswith('.pdf')
+        if self.is_pdf:
+            if pdf2image is None:
+                raise RuntimeError("PDF input needs the pdf2image package (and Poppler)")
+            self.n_pages = int(pdf2image.pdfinfo_from_path(path)['Pages'])
+        else:
+            with Image.open(path) as image:
+                self.n_pages = getattr(image, 'n_frames', 1)
+
+    def __len__(self):
+        return self.n_pages
+
+    @property
+    def multi_page(self):
+        return self.n_pages > 1
+
+    def page(self, index):
+        """
+        The page as an RGB image (index starts from 0).
+        """
+        if not 0 <= index < self.n_pages:
+            raise IndexError(f"{self.path} has {self.n_pages} pages")
+        if self.is_pdf:
+            return pdf2image.convert_from_path(self.path, dpi=PDF_DPI, first_page=index + 1,
+                                               last_page=index + 1)[0].convert("RGB")
+        with Image.open(self.path) as image:
+            image.seek(index)
+            return image.convert("RGB")
+
+    def page_number(self, index):
+        """
+        Page index for the file names: None for single-page files, whose names don't change.
+        """
+        return index if self.multi_page else None
+
+
+class PagePrefetcher:
+    """
+    Decodes, preprocesses and OCRs the next pages of a document in a background thread, while the user
+    works on the current one.
+    """
+
+    def __init__(self, document, lang):
+        self.document = document
+        self.lang = lang
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pages = {}  # index -> (image future, lines future)
+
+    def _decode(self, index):
+        return preprocess_page(self.document.page(index))
+
+    def _ocr(self, image_future):
+        return extract_text_lines(image_future.result(), self.lang)
+
+    def prefetch(self, index):
+        if 0 <= index < len(self.document) and index not in self.pages:
+            image_future = self.executor.submit(self._decode, index)
+            self.pages[index] = (image_future, self.executor.submit(self._ocr, image_future))
+
+    def take(self, index):
+        """
+        (image, lines future) of a page. The future is None if the page wasn't prefetched: its OCR is still to do.
+        """
+        if index in self.pages:
+            image_future, lines_future = self.pages.pop(index)
+            return image_future.result(), lines_future
+        return self._decode(index), None
+
+    def shutdown(self):
+        for image_future, lines_future in self.pages.values():
+            image_future.cancel()
+            lines_future.cancel()
+        self.pages = {}
+        self.executor.shutdown(wait=False)
+
+
+# --- Session journal (autosave of the GUI workflow) ---
+
+class SessionJournal:
+    """
+    Append-only journal of the lines of a GUI session, so that a crash or an Escape doesn't lose the OCR and the
+    corrections. Every change of a line is one JSON line ({'runtime', 'uid', 'op', 'line'}) in
+    SESSION_JOURNAL_DIR/<image key>.jsonl, where the key is the hash of the image file, the page and the preprocessing.
+    Entries are serialised and appended by a writer thread, which also rewrites the journal with only the
+    current lines every SESSION_JOURNAL_COMPACT_EVERY entries. The journal is deleted when the GT files are saved.
+    """
+
+    def __init__(self, image_path, page=None, folder=SESSION_JOURNAL_DIR):
+        self.key = hashlib.sha256(f"{_file_sha256(image_path)}{page}{PAGE_PREPROCESS_STEPS}".encode()).hexdigest()
+        self.path = os.path.join(folder, f"{self.key}.jsonl")
+        self.queue = queue.Queue()
+        self.thread = None
+
+    @staticmethod
+    def line_entry(record):
+        return {'bbox': record.bbox, 'text': record.text, 'line_num': record.line_num,
+                'confidence': record.confidence, 'baseline': record.baseline,
+                'word_confidences': record.word_confidences}
+
+    def _read_state(self):
+        lines, stage = OrderedDict(), {}
+        if not os.path.exists(self.path):
+            return lines, stage
+        with open(self.path, encoding='utf-8') as f:
+            for row in f:
+                try:
+                    entry = json.loads(row)
+                except ValueError:
+                    break  # Last line cut by a crash
+                key = (entry.get('runtime'), entry.get('uid'))
+                if entry['op'] == 'put':
+                    lines[key] = entry['line']
+                elif entry['op'] == 'delete':
+                    lines.pop(key, None)
+                elif entry['op'] == 'stage':
+                    stage.update(entry['stage'])
+        return lines, stage
+
+    def load(self):
+        """
+        Returns the lines (dictionaries) and the stage ({'ocr': 'finished', 'step': 'verify'...}) of the journal.
+        """
+        lines, stage = self._read_state()
+        return list(lines.values()), stage
+
+    def restore(self, source):
+        """
+        LineRecords of the journaled lines, cropped from source (the page, as loaded and preprocessed).
+        The journal is rewritten with them, under this runtime.
+        """
+        lines, stage = self.load()
+        records = [LineRecord(source, line['bbox'], line['text'], line_num, confidence=line.get('confidence'),
+                              baseline=line.get('baseline'), word_confidences=line.get('word_confidences'))
+                   for line_num, line in enumerate(lines)]
+        self._append({'op': 'reset', 'lines': [(record.uid, self.line_entry(record)) for record in records],
+                      'stage': stage})
+        return records
+
+    def _append(self, entry):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._writer, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+        self.queue.put(entry)
+
+    def put(self, record):
+        self._append({'op': 'put', 'uid': record.uid, 'line': self.line_entry(record)})
+
+    def delete(self, record):
+        self._append({'op': 'delete', 'uid': record.uid})
+
+    def stage(self, **stage):
+        self._append({'op': 'stage', 'stage': stage})
+
+    def _compact(self, lines, stage):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = f"{self.path}.tmp{RUNTIME_ID}"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            if stage:
+                f.write(json.dumps({'runtime': RUNTIME_ID, 'op': 'stage', 'stage': stage}) + "\n")
+            for (runtime, uid), line in lines.items():
+                f.write(json.dumps({'runtime': runtime, 'uid': uid, 'op': 'put', 'line': line}) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def _writer(self):
+        # Runs in the writer thread: the UI thread only queues the entries
+        lines, stage = self._read_state()
+        f = None
+        appended = 0
+        closing = False
+        while not closing:
+            entries = [self.queue.get()]
+            while True:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                for entry in entries:
+                    if entry is None or entry['op'] == 'discard':
+                        closing = True
+                        if entry is not None:
+                            if f is not None:
+                                f.close()
+                            if os.path.exists(self.path):
+                                os.remove(self.path)
+                            return
+                        break
+                    if entry['op'] == 'reset':
+                        lines = OrderedDict(((RUNTIME_ID, uid), line) for uid, line in entry['lines'])
+                        stage = dict(entry['stage'])
+                        appended = SESSION_JOURNAL_COMPACT_EVERY  # Rewrite the journal now
+                        continue
+                    entry['runtime'] = RUNTIME_ID
+                    key = (RUNTIME_ID, entry.get('uid'))
+                    if entry['op'] == 'put':
+                        lines[key] = entry['line']
+                    elif entry['op'] == 'delete':
+                        lines.pop(key, None)
+                    elif entry['op'] == 'stage':
+                        stage.update(entry['stage'])
+                    if f is None:
+                        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                        f = open(self.path, 'a', encoding='utf-8')
+                    f.write(json.dumps(entry) + "\n")
+                    appended += 1
+                if f is not None:
+                    f.flush()
+                if appended >= SESSION_JOURNAL_COMPACT_EVERY:
+                    if f is not None:
+                        f.close()
+                        f = None
+                    self._compact(lines, stage)
+                    appended = 0
+            except Exception as e:
+                print(f"Error writing session journal {self.path}: {e}")
+        if f is not None:
+            f.close()
+
+    def close(self, discard=False):
+        """
+        Waits for the queued entries to be written; discard=True deletes the journal (the session was saved).
+        """
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.put({'op': 'discard'} if discard else None)
+            self.thread.join()
+        elif discard and os.path.exists(self.path):
+            os.remove(self.path)
 
 
 # --- Tkinter GUI Classes ---
@@ -76,29 +1820,75 @@ class TkDrawBorders(tk.Toplevel):
     GUI to draw and verify bounding boxes for lines on an image.
     """
 
-    def __init__(self, image_path, **kwargs):
+    def __init__(self, image_path, journal=None, restore=False, image=None, ocr_future=None, page_label="",
+                 **kwargs):
         super().__init__(**kwargs)
-        self.title("Draw Borders (Line-based)")
+        self.window_title = f"Draw Borders (Line-based){page_label}"
+        self.title(self.window_title)
         self.geometry("1200x800")
         self.file_path = image_path  # Now it's an image path
+        self.page_image = image  # The page, already decoded and preprocessed (e.g. by a PagePrefetcher)
+        self.ocr_future = ocr_future  # Future of the lines of the page when its OCR was prefetched
+        self.journal = journal  # SessionJournal where every change of the lines is saved
+        self.restore = restore  # Restore the lines from the journal instead of running the OCR
 
         self.original_image = None  # Stores the original high-res image
-        self.display_image = None  # Stores the scaled-down image for display
-        self.photo_image = None  # Stores the Tkinter PhotoImage
+        self.pyramid = None  # Downscaled levels of original_image, the display is rendered from them in tiles
+        self.zoom = 1.0  # Display pixels per original pixel
+        self.min_zoom = 1.0
+        self.tile_cache = LRUCache(DISPLAY_TILE_CACHE_SIZE)  # (zoom, tile_x, tile_y) -> PhotoImage
+        INSTRUMENTS.watch_cache('display_tile_cache', self.tile_cache)
+        self.visible_tiles = {}  # (tile_x, tile_y) -> (canvas item, PhotoImage) currently on the canvas
+        self.render_pending = False
+        self.scale_factor_x = 1.0
+        self.scale_factor_y = 1.0
 
         self.start_x = None
         self.start_y = None
         self.current_rectangle = None
 
         self.line_data_for_gt = []  # Will store extracted line data for GT
-
-        self.canvas = tk.Canvas(self, bg="white", cursor="cross")
-        self.canvas.pack(fill="both", expand=True)
+        self.records = {}  # uid -> LineRecord of line_data_for_gt
+        self.box_items = {}  # uid -> (rectangle, label) canvas items of the line boxes
+        self.box_index = LineBoxIndex()  # Hit-testing of the line boxes, in original image coordinates
+        self.selected_uid = None
+        self.drag_mode = None  # 'draw' a new box, 'move' or 'resize' the selected one
+        self.drag_edges = ()  # Borders of the selected box moved by a resize: 'left', 'top', 'right', 'bottom'
+        self.drag_bbox = None  # bbox of the selected box while it's moved or resized
+        self.undo_stack = []  # [record, state before, state after, list position] of the box edits, see apply_box_state
+        self.redo_stack = []
+        self.reocr_executor = ThreadPoolExecutor(max_workers=1)  # Re-OCR of the edited boxes, one at a time
+
+        self.ocr_queue = queue.Queue()  # Lines recognised by the background OCR thread, consumed by poll_ocr_queue
+        self.ocr_cancel = threading.Event()
+        self.ocr_thread = None
+
+        self.canvas_frame = tk.Frame(self)
+        self.canvas_frame.pack(fill="both", expand=True)
+        self.canvas_frame.rowconfigure(0, weight=1)
+        self.canvas_frame.columnconfigure(0, weight=1)
+
+        self.canvas = tk.Canvas(self.canvas_frame, bg="white", cursor="cross")
+        self.hbar = tk.Scrollbar(self.canvas_frame, orient="horizontal", command=self.canvas.xview)
+        self.vbar = tk.Scrollbar(self.canvas_frame, orient="vertical", command=self.canvas.yview)
+        self.canvas.configure(xscrollcommand=self.on_xscroll, yscrollcommand=self.on_yscroll)
+        self.canvas.grid(row=0, column=0, sticky="nsew")
+        self.vbar.grid(row=0, column=1, sticky="ns")
+        self.hbar.grid(row=1, column=0, sticky="ew")
 
         self.canvas.bind("<ButtonPress-1>", self.on_button_press)
         self.canvas.bind("<B1-Motion>", self.on_mouse_drag)
         self.canvas.bind("<ButtonRelease-1>", self.on_button_release)
 
+        # Zoom with the mouse wheel, pan by dragging with the middle/right button
+        self.canvas.bind("<Configure>", lambda event: self.schedule_render())
+        self.canvas.bind("<MouseWheel>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-4>", self.on_mouse_wheel)
+        self.canvas.bind("<Button-5>", self.on_mouse_wheel)
+        for button in (2, 3):
+            self.canvas.bind(f"<ButtonPress-{button}>", lambda event: self.canvas.scan_mark(event.x, event.y))
+            self.canvas.bind(f"<B{button}-Motion>", lambda event: self.canvas.scan_dragto(event.x, event.y, gain=1))
+
         self.button_frame = tk.Frame(self)
         self.button_frame.pack(side="bottom", fill="x")
 
@@ -106,182 +1896,482 @@ class TkDrawBorders(tk.Toplevel):
         self.finish_button.pack(side="right", padx=5, pady=5)
 
         self.bind("<Escape>", self.on_escape_key)
+        self.bind("<Delete>", self.on_delete_key)
+        self.bind("<BackSpace>", self.on_delete_key)
+        self.bind("<Control-z>", lambda event: self.undo())
+        self.bind("<Control-y>", lambda event: self.redo())
+        self.bind("<Control-Z>", lambda event: self.redo())  # Ctrl+Shift+Z
 
         self.load_image_and_ocr()
 
     def load_image_and_ocr(self):
         print(f"Processing image: {os.path.basename(self.file_path)}")
         try:
-            self.original_image = Image.open(self.file_path).convert("RGB")
+            if self.page_image is not None:
+                self.original_image = self.page_image
+            else:
+                self.original_image = preprocess_page(Image.open(self.file_path).convert("RGB"))
         except Exception as e:
             print(f"Error opening image {self.file_path}: {e}")
             self.destroy()
             return
 
-        # Calculate display_image and its scale factor
-        self.display_image = self.original_image.copy()
-        maxsize = (1000, 700)
-        self.display_image.thumbnail(maxsize, Image.LANCZOS)
-
-        # This is the ratio of the size of the original image to the size of the displayed image
-        # Make sure you don't divide by zero if the image is too small or empty
-        if self.display_image.width > 0 and self.display_image.height > 0:
-            self.scale_factor_x = self.original_image.width / self.display_image.width
-            self.scale_factor_y = self.original_image.height / self.display_image.height
+        # The image is shown fitted into DISPLAY_MAX_SIZE, then it can be zoomed in up to DISPLAY_MAX_ZOOM
+        self.pyramid = ImagePyramid(self.original_image)
+        if self.original_image.width > 0 and self.original_image.height > 0:
+            self.min_zoom = min(DISPLAY_MAX_SIZE[0] / self.original_image.width,
+                                DISPLAY_MAX_SIZE[1] / self.original_image.height, 1.0)
         else:
-            self.scale_factor_x = 1.0
-            self.scale_factor_y = 1.0
-            print("WARNING: Display image has zero dimensions, scaling might be incorrect.")
+            self.min_zoom = 1.0
+            print("WARNING: Image has zero dimensions, scaling might be incorrect.")
+        self.set_zoom(self.min_zoom)
+
+        if self.restore:
+            ocr_status = self.journal.load()[1].get('ocr')
+            for data in self.journal.restore(self.original_image):
+                self.add_line_box(data, journal=False)
+            print(f"Session restored: {len(self.line_data_for_gt)} lines")
+            if ocr_status != 'finished':
+                print("WARNING: the OCR of the restored session had not finished, some lines may be missing.")
+            return
 
-        self.photo_image = ImageTk.PhotoImage(self.display_image)
-        self.canvas.create_image(0, 0, image=self.photo_image, anchor="nw")
-        self.canvas.config(scrollregion=self.canvas.bbox(tk.ALL))
+        # Perform OCR in background: lines are drawn as soon as they are recognised
+        self.title(f"{self.window_title} - OCR running...")
+        self.ocr_thread = threading.Thread(target=self.ocr_worker, args=(self.original_image,), daemon=True)
+        self.ocr_thread.start()
+        self.after(OCR_POLL_INTERVAL_MS, self.poll_ocr_queue)
 
-        # Perform OCR to get initial line data
-        self.line_data_for_gt = self.ocr_extraction(self.original_image)
-        self.draw_bounding_boxes()
-        
-    def ocr_extraction(self, image_pil):
+    def set_zoom(self, zoom, anchor_x=0, anchor_y=0):
         """
-        Extracts line-level OCR data.
+        Zooms the display keeping the point under (anchor_x, anchor_y) (window coordinates) still.
         """
-        extracted_lines = []
+        zoom = max(self.min_zoom, min(DISPLAY_MAX_ZOOM, zoom))
+        if zoom == self.zoom and self.visible_tiles:
+            return
+        factor = zoom / self.zoom
+        anchor_orig_x = self.canvas.canvasx(anchor_x) / self.zoom
+        anchor_orig_y = self.canvas.canvasy(anchor_y) / self.zoom
 
-        global USE_TESSEROCR  # Allows modification if tesserocr fails
+        self.zoom = zoom
+        # This is the ratio of the size of the original image to the size of the displayed image
+        self.scale_factor_x = 1 / zoom
+        self.scale_factor_y = 1 / zoom
 
-        if USE_TESSEROCR:
-            try:
-                with tesserocr.PyTessBaseAPI(path=TESSDATA_FOLDER, lang=args["language"]) as api:
-                    api.SetImage(image_pil)
-
-                    for i, (line_img, line_bbox, _, _) in enumerate(api.GetComponentImages(RIL.TEXTLINE, True)):
-                        api.SetRectangle(line_bbox['x'], line_bbox['y'], line_bbox['w'], line_bbox['h'])
-                        text = api.GetUTF8Text().strip()
-
-                        if text:
-                            extracted_lines.append({
-                                'image': line_img,
-                                'text': text,
-                                'bbox': line_bbox,
-                                'line_num': len(extracted_lines)
-                            })
-            except Exception as e:
-                print(f"tesserocr OCR extraction failed: {e}")
-                print("Falling back to pytesseract...")
-                USE_TESSEROCR = False
+        # Boxes are moved, not redrawn
+        self.canvas.scale("line_box", 0, 0, factor, factor)
+        self.canvas.scale("drawn_box", 0, 0, factor, factor)
 
-        if not USE_TESSEROCR:  # Fallback to pytesseract
-            try:
-                data = pytesseract.image_to_data(image_pil, lang=args["language"], output_type=pytesseract.Output.DICT)
-
-                for i in range(len(data['level'])):
-                    if data['level'][i] == 4:  # Level 4 is for TEXTLINE
-                        x, y, w, h = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
-                        line_text = data['text'][i].strip()
-
-                        if line_text:
-                            cropped_line_img = image_pil.crop((x, y, x + w, y + h))
-                            extracted_lines.append({
-                                'image': cropped_line_img,
-                                'text': line_text,
-                                'bbox': {'x': x, 'y': y, 'w': w, 'h': h},
-                                'line_num': len(extracted_lines)
-                            })
-            except Exception as e:
-                print(f"pytesseract OCR extraction failed: {e}")
-                print("OCR extraction failed completely. No lines will be processed.")
-                extracted_lines = []
+        width, height = self.pyramid.display_size(zoom)
+        self.canvas.config(scrollregion=(0, 0, width, height))
+        self.canvas.xview_moveto(max(0.0, (anchor_orig_x * zoom - anchor_x) / width))
+        self.canvas.yview_moveto(max(0.0, (anchor_orig_y * zoom - anchor_y) / height))
 
-        return extracted_lines
+        for item, _ in self.visible_tiles.values():
+            self.canvas.delete(item)
+        self.visible_tiles = {}
+        self.schedule_render()
 
+    def on_mouse_wheel(self, event):
+        if self.pyramid is None:
+            return
+        zoom_in = event.num == 4 or getattr(event, 'delta', 0) > 0
+        step = DISPLAY_ZOOM_STEP if zoom_in else 1 / DISPLAY_ZOOM_STEP
+        self.set_zoom(self.zoom * step, event.x, event.y)
+
+    def on_xscroll(self, first, last):
+        self.hbar.set(first, last)
+        self.schedule_render()
+
+    def on_yscroll(self, first, last):
+        self.vbar.set(first, last)
+        self.schedule_render()
+
+    def schedule_render(self):
+        if not self.render_pending:
+            self.render_pending = True
+            self.after_idle(self.render_visible_tiles)
+
+    def render_visible_tiles(self):
+        """
+        Puts on the canvas only the tiles inside the viewport, rendering the ones not in tile_cache.
+        """
+        self.render_pending = False
+        if self.pyramid is None or not self.winfo_exists():
+            return
+
+        tile = DISPLAY_TILE_SIZE
+        width, height = self.pyramid.display_size(self.zoom)
+        view_x1 = max(0, self.canvas.canvasx(0))
+        view_y1 = max(0, self.canvas.canvasy(0))
+        view_x2 = min(width, view_x1 + self.canvas.winfo_width())
+        view_y2 = min(height, view_y1 + self.canvas.winfo_height())
+
+        wanted = {(tx, ty)
+                  for tx in range(int(view_x1 // tile), int(math.ceil(view_x2 / tile)))
+                  for ty in range(int(view_y1 // tile), int(math.ceil(view_y2 / tile)))}
+
+        for key in [key for key in self.visible_tiles if key not in wanted]:
+            self.canvas.delete(self.visible_tiles.pop(key)[0])
+
+        for tx, ty in wanted:
+            if (tx, ty) in self.visible_tiles:
+                continue
+            cache_key = (round(self.zoom, 6), tx, ty)
+            photo = self.tile_cache.get(cache_key)
+            if photo is None:
+                box = (tx * tile, ty * tile, min((tx + 1) * tile, width), min((ty + 1) * tile, height))
+                with INSTRUMENTS.span('gui.render_tile'):
+                    photo = ImageTk.PhotoImage(self.pyramid.render(self.zoom, box))
+                self.tile_cache.put(cache_key, photo)
+            item = self.canvas.create_image(tx * tile, ty * tile, image=photo, anchor="nw", tags="tile")
+            self.visible_tiles[(tx, ty)] = (item, photo)  # Keep the PhotoImage alive while it's shown
+
+        self.canvas.tag_lower("tile")
+
+    def ocr_worker(self, image_pil):
+        # Runs in the OCR thread: it must not touch any Tk widget, only the queue
+        try:
+            lines = None
+            if self.ocr_future is not None:
+                while not self.ocr_future.done():  # The prefetched OCR is still running
+                    if self.ocr_cancel.wait(OCR_POLL_INTERVAL_MS / 1000):
+                        return
+                try:
+                    lines = self.ocr_future.result()
+                except Exception as e:
+                    print(f"Prefetched OCR failed ({e}), running it again...")
+            if lines is None:
+                lines = iter_text_lines(image_pil, args["language"], cancel_event=self.ocr_cancel)
+            for data in lines:
+                if self.ocr_cancel.is_set():
+                    break
+                self.ocr_queue.put(data)
+        finally:
+            self.ocr_queue.put(None)  # End of OCR
+
+    def poll_ocr_queue(self):
+        if not self.winfo_exists():
+            return
+        finished = False
+        try:
+            while True:
+                data = self.ocr_queue.get_nowait()
+                if data is None:
+                    finished = True
+                    break
+                data['line_num'] = len(self.line_data_for_gt)  # Manual boxes may have been added meanwhile
+                self.add_line_box(data)
+        except queue.Empty:
+            pass
+        # A single-pass OCR can't be interrupted inside Recognize(): on cancel the window stops waiting for it,
+        # and the OCR thread ends on its own, dropping its lines
+        finished = finished or self.ocr_cancel.is_set()
+
+        if finished:
+            status = "cancelled" if self.ocr_cancel.is_set() else "finished"
+            print(f"OCR {status}: {len(self.line_data_for_gt)} lines")
+            if self.journal is not None:
+                self.journal.stage(ocr=status)
+            self.title(self.window_title)
+        else:
+            self.title(f"{self.window_title} - OCR running... {len(self.line_data_for_gt)} lines")
+            self.after(OCR_POLL_INTERVAL_MS, self.poll_ocr_queue)
+
+    def ocr_running(self):
+        return self.ocr_thread is not None and self.ocr_thread.is_alive()
+
+    def display_coords(self, bbox):
+        # Le coordinate in bbox sono già quelle dell'original_image
+        # Le scali per la visualizzazione:
+        return (bbox['x'] / self.scale_factor_x, bbox['y'] / self.scale_factor_y,
+                (bbox['x'] + bbox['w']) / self.scale_factor_x, (bbox['y'] + bbox['h']) / self.scale_factor_y)
+
+    def draw_line_box(self, data):
+        scaled_x1, scaled_y1, scaled_x2, scaled_y2 = self.display_coords(data['bbox'])
+        selected = data.uid == self.selected_uid
+        rectangle = self.canvas.create_rectangle(scaled_x1, scaled_y1, scaled_x2, scaled_y2,
+                                                 outline="orange" if selected else "blue", width=2 if selected else 1,
+                                                 tags="line_box")
+        label = self.canvas.create_text(scaled_x1, scaled_y1 - 5, anchor="sw", text=data['text'][:30], fill="red",
+                                        tags="line_box")
+        self.box_items[data.uid] = (rectangle, label)
+
+    def update_line_box(self, data, bbox=None):
+        # Only the two items of this box are changed
+        rectangle, label = self.box_items[data.uid]
+        scaled_x1, scaled_y1, scaled_x2, scaled_y2 = self.display_coords(bbox or data['bbox'])
+        self.canvas.coords(rectangle, scaled_x1, scaled_y1, scaled_x2, scaled_y2)
+        self.canvas.coords(label, scaled_x1, scaled_y1 - 5)
+        self.canvas.itemconfigure(label, text=data['text'][:30])
+        selected = data.uid == self.selected_uid
+        self.canvas.itemconfigure(rectangle, outline="orange" if selected else "blue", width=2 if selected else 1)
+
+    def add_line_box(self, data, journal=True, position=None):
+        if position is None:
+            self.line_data_for_gt.append(data)
+        else:
+            self.line_data_for_gt.insert(position, data)
+        self.records[data.uid] = data
+        self.box_index.insert(data.uid, data.x, data.y, data.x + data.w, data.y + data.h)
+        self.draw_line_box(data)
+        if journal and self.journal is not None:
+            self.journal.put(data)
+
+    def remove_line_box(self, data):
+        if self.journal is not None:
+            self.journal.delete(data)
+        self.line_data_for_gt.remove(data)
+        del self.records[data.uid]
+        self.box_index.remove(data.uid)
+        for item in self.box_items.pop(data.uid):
+            self.canvas.delete(item)
+        if self.selected_uid == data.uid:
+            self.selected_uid = None
+
+    def select_box(self, uid):
+        previous, self.selected_uid = self.selected_uid, uid
+        for changed in (previous, uid):
+            if changed is not None and changed in self.records:
+                self.update_line_box(self.records[changed])
+
+    @staticmethod
+    def box_state(data):
+        return data['bbox'], data['text']
+
+    def apply_box_state(self, data, state, position=None):
+        """
+        Brings a line box to a state: None (not on the page) or (bbox, text).
+        A box put back on the page goes to its position in line_data_for_gt, which sets its line number.
+        """
+        present = data.uid in self.records
+        if state is None:
+            if present:
+                self.remove_line_box(data)
+            return
+        data['bbox'], data['text'] = state
+        if present:
+            self.box_index.insert(data.uid, data.x, data.y, data.x + data.w, data.y + data.h)
+            self.update_line_box(data)
+            if self.journal is not None:
+                self.journal.put(data)
+        else:
+            self.add_line_box(data, position=position)
 
-    def draw_bounding_boxes(self):
-        self.canvas.delete("line_box")
-        for data in self.line_data_for_gt:
-            bbox = data['bbox']
-            # Le coordinate in bbox sono già quelle dell'original_image
-            # Le scali per la visualizzazione:
-            scaled_x1 = bbox['x'] / self.scale_factor_x  # Usa i nuovi fattori
-            scaled_y1 = bbox['y'] / self.scale_factor_y  # Usa i nuovi fattori
-            scaled_x2 = (bbox['x'] + bbox['w']) / self.scale_factor_x
-            scaled_y2 = (bbox['y'] + bbox['h']) / self.scale_factor_y
+    def edit_box(self, data, after):
+        """
+        Applies a box edit and records it in the undo history.
+        """
+        if data.uid in self.records:
+            before, position = self.box_state(data), self.line_data_for_gt.index(data)
+        else:
+            before, position = None, len(self.line_data_for_gt)
+        self.undo_stack.append([data, before, after, position])
+        del self.undo_stack[:-EDIT_HISTORY_SIZE]
+        self.redo_stack.clear()
+        self.apply_box_state(data, after)
+
+    def undo(self):
+        if not self.undo_stack:
+            return
+        edit = self.undo_stack.pop()
+        self.apply_box_state(edit[0], edit[1], edit[3])
+        self.redo_stack.append(edit)
 
-            self.canvas.create_rectangle(scaled_x1, scaled_y1, scaled_x2, scaled_y2,
-                                         outline="blue", tags="line_box")
-            self.canvas.create_text(scaled_x1, scaled_y1 - 5, anchor="sw", text=data['text'][:30], fill="red",
-                                    tags="line_box")
+    def redo(self):
+        if not self.redo_stack:
+            return
+        edit = self.redo_stack.pop()
+        self.apply_box_state(edit[0], edit[2], edit[3])
+        self.undo_stack.append(edit)
+
+    def reocr_box(self, data):
+        """
+        Recognises again only the text of an edited box, in background.
+        """
+        bbox = data['bbox']
+        future = self.reocr_executor.submit(recognize_region, data.image, args["language"])
+        self.after(OCR_POLL_INTERVAL_MS, self.poll_reocr, data, bbox, future)
+
+    def poll_reocr(self, data, bbox, future):
+        if not self.winfo_exists():
+            return
+        if not future.done():
+            self.after(OCR_POLL_INTERVAL_MS, self.poll_reocr, data, bbox, future)
+            return
+        try:
+            text = future.result()
+        except Exception as e:
+            print(f"OCR of the edited box failed: {e}")
+            return
+        # The edit that asked for this OCR now also restores its text on redo
+        for edit in self.undo_stack + self.redo_stack:
+            if edit[0] is data and edit[2] is not None and edit[2][0] == bbox:
+                edit[2] = (bbox, text)
+        if data.uid in self.records and data['bbox'] == bbox:  # Not moved again meanwhile
+            data['text'] = text
+            data['confidence'] = None
+            data['word_confidences'] = None
+            self.update_line_box(data)
+            if self.journal is not None:
+                self.journal.put(data)
+
+    def hit_edges(self, uid, x, y, margin):
+        x1, y1, x2, y2 = self.box_index.boxes[uid]
+        edges = []
+        if abs(x - x1) <= margin:
+            edges.append('left')
+        elif abs(x - x2) <= margin:
+            edges.append('right')
+        if abs(y - y1) <= margin:
+            edges.append('top')
+        elif abs(y - y2) <= margin:
+            edges.append('bottom')
+        return tuple(edges)
 
     def on_button_press(self, event):
         self.start_x = self.canvas.canvasx(event.x)
         self.start_y = self.canvas.canvasy(event.y)
+
+        # Pressing on a box selects it: its borders resize it, its inside moves it
+        orig_x, orig_y = self.start_x * self.scale_factor_x, self.start_y * self.scale_factor_y
+        margin = BOX_HANDLE_SIZE * self.scale_factor_x
+        hits = self.box_index.at(orig_x, orig_y, margin)
+        if hits:
+            uid = hits[0]
+            self.select_box(uid)
+            self.drag_edges = self.hit_edges(uid, orig_x, orig_y, margin)
+            self.drag_mode = 'resize' if self.drag_edges else 'move'
+            self.drag_bbox = self.records[uid]['bbox']
+            return
+
+        self.select_box(None)
+        self.drag_mode = 'draw'
         self.current_rectangle = self.canvas.create_rectangle(self.start_x, self.start_y, self.start_x, self.start_y,
                                                               outline="red", tags="drawn_box")
 
+    def dragged_bbox(self, data, cur_x, cur_y):
+        dx = int((cur_x - self.start_x) * self.scale_factor_x)
+        dy = int((cur_y - self.start_y) * self.scale_factor_y)
+        x1, y1, x2, y2 = data.x, data.y, data.x + data.w, data.y + data.h
+        if self.drag_mode == 'move':
+            x1, y1, x2, y2 = x1 + dx, y1 + dy, x2 + dx, y2 + dy
+        else:
+            if 'left' in self.drag_edges:
+                x1 = min(x1 + dx, x2 - 1)
+            if 'right' in self.drag_edges:
+                x2 = max(x2 + dx, x1 + 1)
+            if 'top' in self.drag_edges:
+                y1 = min(y1 + dy, y2 - 1)
+            if 'bottom' in self.drag_edges:
+                y2 = max(y2 + dy, y1 + 1)
+        # Keep the box inside the page
+        width, height = self.original_image.size
+        shift_x = max(0, -x1) - max(0, x2 - width) if self.drag_mode == 'move' else 0
+        shift_y = max(0, -y1) - max(0, y2 - height) if self.drag_mode == 'move' else 0
+        x1, x2 = max(0, x1 + shift_x), min(width, x2 + shift_x)
+        y1, y2 = max(0, y1 + shift_y), min(height, y2 + shift_y)
+        return {'x': x1, 'y': y1, 'w': x2 - x1, 'h': y2 - y1}
+
     def on_mouse_drag(self, event):
         cur_x = self.canvas.canvasx(event.x)
         cur_y = self.canvas.canvasy(event.y)
-        self.canvas.coords(self.current_rectangle, self.start_x, self.start_y, cur_x, cur_y)
+        if self.drag_mode == 'draw':
+            self.canvas.coords(self.current_rectangle, self.start_x, self.start_y, cur_x, cur_y)
+        elif self.drag_mode in ('move', 'resize') and self.selected_uid in self.records:
+            # Only the canvas items follow the mouse: the model and the index change on release
+            data = self.records[self.selected_uid]
+            self.drag_bbox = self.dragged_bbox(data, cur_x, cur_y)
+            self.update_line_box(data, self.drag_bbox)
 
     def on_button_release(self, event):
-        def on_button_release(self, event):
-            end_x = self.canvas.canvasx(event.x)
-            end_y = self.canvas.canvasy(event.y)
-
-            # Applica i fattori di scala separatamente per X e Y
-            orig_x1 = int(min(self.start_x, end_x) * self.scale_factor_x)
-            orig_y1 = int(min(self.start_y, end_y) * self.scale_factor_y)
-            orig_x2 = int(max(self.start_x, end_x) * self.scale_factor_x)
-            orig_y2 = int(max(self.start_y, end_y) * self.scale_factor_y)
-
-            orig_w = orig_x2 - orig_x1
-            orig_h = orig_y2 - orig_y1
-
-            print(f"DEBUG: Drawn box (display): {self.start_x},{self.start_y} to {end_x},{end_y}")
-            print(f"DEBUG: Drawn box (original scaled): {orig_x1},{orig_y1} w={orig_w} h={orig_h}")
-
-            if orig_w > 0 and orig_h > 0:
-                cropped_img = self.original_image.crop((orig_x1, orig_y1, orig_x1 + orig_w, orig_y1 + orig_h))
-            ocr_text = ""
-            global USE_TESSEROCR
-            if USE_TESSEROCR:
-                try:
-                    with tesserocr.PyTessBaseAPI(path=TESSDATA_FOLDER, lang=args["language"]) as api:
-                        api.SetImage(cropped_img)
-                        ocr_text = api.GetUTF8Text().strip()
-                except Exception:
-                    ocr_text = pytesseract.image_to_string(cropped_img, lang=args["language"]).strip()
-            else:
-                ocr_text = pytesseract.image_to_string(cropped_img, lang=args["language"]).strip()
+        drag_mode, self.drag_mode = self.drag_mode, None
+        if drag_mode in ('move', 'resize'):
+            data = self.records.get(self.selected_uid)
+            if data is not None and self.drag_bbox != data['bbox']:
+                self.edit_box(data, (self.drag_bbox, data['text']))
+                self.reocr_box(data)
+            return
+        if drag_mode != 'draw':
+            return
+
+        end_x = self.canvas.canvasx(event.x)
+        end_y = self.canvas.canvasy(event.y)
+
+        # Applica i fattori di scala separatamente per X e Y
+        orig_x1 = int(min(self.start_x, end_x) * self.scale_factor_x)
+        orig_y1 = int(min(self.start_y, end_y) * self.scale_factor_y)
+        orig_x2 = int(max(self.start_x, end_x) * self.scale_factor_x)
+        orig_y2 = int(max(self.start_y, end_y) * self.scale_factor_y)
+
+        orig_w = orig_x2 - orig_x1
+        orig_h = orig_y2 - orig_y1
 
-            new_line_data = {
-                'image': cropped_img,
-                'text': ocr_text,
-                'bbox': {'x': orig_x1, 'y': orig_y1, 'w': orig_w, 'h': orig_h},
-                'line_num': len(self.line_data_for_gt)
-            }
-            self.line_data_for_gt.append(new_line_data)
-            self.draw_bounding_boxes()
+        print(f"DEBUG: Drawn box (display): {self.start_x},{self.start_y} to {end_x},{end_y}")
+        print(f"DEBUG: Drawn box (original scaled): {orig_x1},{orig_y1} w={orig_w} h={orig_h}")
+
+        self.canvas.delete(self.current_rectangle)
+        if orig_w <= 0 or orig_h <= 0:
+            return
+
+        new_line_data = LineRecord(self.original_image, {'x': orig_x1, 'y': orig_y1, 'w': orig_w, 'h': orig_h},
+                                   '', len(self.line_data_for_gt))
+        self.edit_box(new_line_data, self.box_state(new_line_data))
+        self.select_box(new_line_data.uid)
+        self.reocr_box(new_line_data)
+
+    def on_delete_key(self, event):
+        data = self.records.get(self.selected_uid)
+        if data is not None and self.drag_mode is None:
+            self.edit_box(data, None)
 
     def on_escape_key(self, event):
+        # The first Escape stops a running OCR (keeping the lines found so far), the next one closes the window
+        if self.ocr_running() and not self.ocr_cancel.is_set():
+            print("Cancelling OCR...")
+            self.ocr_cancel.set()
+            return
         self.destroy()
 
     def finish(self):
+        self.ocr_cancel.set()
+        # Collect the lines recognised after the last poll
+        while True:
+            try:
+                data = self.ocr_queue.get_nowait()
+            except queue.Empty:
+                break
+            if data is not None:
+                self.line_data_for_gt.append(data)
+        for line_num, data in enumerate(self.line_data_for_gt):  # Boxes may have been deleted
+            data['line_num'] = line_num
         global GLOBAL_LINE_DATA
         GLOBAL_LINE_DATA = self.line_data_for_gt
         self.destroy()
 
+    def destroy(self):
+        self.ocr_cancel.set()
+        self.reocr_executor.shutdown(wait=False)
+        super().destroy()
+
 
 class TkVerifyWords(tk.Toplevel):
     """
     GUI to verify and correct extracted line text.
+    Lines can be reviewed in page order, from the lowest OCR confidence, or only the doubtful ones
+    (lines at or above REVIEW_AUTO_ACCEPT_CONFIDENCE are auto-accepted and skipped).
     """
 
-    def __init__(self, line_data, **kwargs):
+    def __init__(self, line_data, journal=None, **kwargs):
         super().__init__(**kwargs)
         self.title("Verify Line Text")
         self.geometry("1000x800")
 
         self.line_data = line_data
+        self.journal = journal  # SessionJournal where the corrections are saved
+        if journal is not None:
+            journal.stage(step='verify')
+        self.review_order = list(range(len(line_data)))  # Indices of line_data, in the order they are reviewed
+        self.review_position = 0
         self.current_line_index = 0
 
         self.canvas = tk.Canvas(self, bg="lightgray")
@@ -303,30 +2393,66 @@ class TkVerifyWords(tk.Toplevel):
         self.next_button = tk.Button(self.nav_frame, text="Next", command=self.show_next_line)
         self.next_button.pack(side="left", padx=5)
 
+        self.next_doubtful_button = tk.Button(self.nav_frame, text="Next doubtful",
+                                              command=self.show_next_doubtful_line)
+        self.next_doubtful_button.pack(side="left", padx=5)
+
         self.save_button = tk.Button(self.nav_frame, text="Save & Finish Image", command=self.finish)
         self.save_button.pack(side="right", padx=5)
 
+        self.review_frame = tk.Frame(self)
+        self.review_frame.pack(side="bottom", fill="x", padx=10)
+
+        self.review_mode = tk.StringVar(value="page")
+        for mode, label in (("page", "Page order"), ("confidence", "Lowest confidence first"),
+                            ("doubtful", "Only doubtful lines")):
+            tk.Radiobutton(self.review_frame, text=label, value=mode, variable=self.review_mode,
+                           command=self.apply_review_mode).pack(side="left")
+
+        self.info_label = tk.Label(self.review_frame, anchor="e")
+        self.info_label.pack(side="right", fill="x", expand=True)
+
+        self.display_line()
+
+    @staticmethod
+    def line_confidence(line):
+        confidence = line.get('confidence')
+        return -1.0 if confidence is None else confidence  # Lines without confidence (drawn by hand) come first
+
+    def apply_review_mode(self):
+        self.save_current_line_text()
+        mode = self.review_mode.get()
+        if mode == "page":
+            self.review_order = list(range(len(self.line_data)))
+        else:
+            self.review_order = sorted(range(len(self.line_data)),
+                                       key=lambda i: self.line_confidence(self.line_data[i]))
+            if mode == "doubtful":
+                self.review_order = [i for i in self.review_order
+                                     if self.line_confidence(self.line_data[i]) < REVIEW_AUTO_ACCEPT_CONFIDENCE]
+
+        if self.current_line_index in self.review_order:
+            self.review_position = self.review_order.index(self.current_line_index)
+        else:
+            self.review_position = 0
         self.display_line()
 
     def display_line(self):
-        if not self.line_data:
+        if not self.line_data or not self.review_order:
             self.canvas.delete(tk.ALL)
             self.text_entry.delete(0, tk.END)
-            self.text_entry.insert(0, "No lines to display.")
+            self.text_entry.insert(0, "No lines to display." if not self.line_data else "All lines are auto-accepted.")
             self.prev_button.config(state="disabled")
             self.next_button.config(state="disabled")
-            self.save_button.config(state="disabled")
+            self.next_doubtful_button.config(state="disabled")
+            if not self.line_data:
+                self.save_button.config(state="disabled")
             return
 
+        self.current_line_index = self.review_order[self.review_position]
         current_line = self.line_data[self.current_line_index]
-        cropped_img = current_line['image']
-
-        maxsize = (self.canvas.winfo_width(), self.canvas.winfo_height() - 50)
-        if maxsize[0] == 1 and maxsize[1] == 1:
-            maxsize = (800, 200)
-
-        display_img = cropped_img.copy()
-        display_img.thumbnail(maxsize, Image.LANCZOS)
+        with INSTRUMENTS.span('gui.thumbnail'):
+            display_img = current_line.thumbnail(self.thumbnail_size())
 
         self.photo_image = ImageTk.PhotoImage(display_img)
         self.canvas.delete(tk.ALL)
@@ -336,28 +2462,80 @@ class TkVerifyWords(tk.Toplevel):
         self.text_entry.delete(0, tk.END)
         self.text_entry.insert(0, current_line['text'])
 
+        self.info_label.config(text=self.line_info(current_line))
         self.update_navigation_buttons()
 
+        # While the user reads the current line, prepare the thumbnails of the previous and the next one
+        self.after_idle(self.prefetch_neighbour_lines)
+
+    def line_info(self, line):
+        info = f"Line {self.review_position + 1}/{len(self.review_order)}"
+        confidence = line.get('confidence')
+        if confidence is None:
+            return info
+        info += f" - confidence {confidence:.0f}"
+        if confidence >= REVIEW_AUTO_ACCEPT_CONFIDENCE:
+            info += " (auto-accepted)"
+        doubtful_words = [word for word, word_confidence in line.get('word_confidences', [])
+                          if word_confidence < REVIEW_CONFIDENCE_THRESHOLD]
+        if doubtful_words:
+            info += " - check: " + " ".join(doubtful_words)
+        return info
+
+    def thumbnail_size(self):
+        maxsize = (self.canvas.winfo_width(), self.canvas.winfo_height() - 50)
+        if maxsize[0] == 1 and maxsize[1] == 1:
+            maxsize = (800, 200)
+        return maxsize
+
+    def prefetch_neighbour_lines(self):
+        if not self.winfo_exists():
+            return
+        maxsize = self.thumbnail_size()
+        for position in (self.review_position + 1, self.review_position - 1):
+            if 0 <= position < len(self.review_order):
+                self.line_data[self.review_order[position]].thumbnail(maxsize)
+
     def update_navigation_buttons(self):
-        self.prev_button.config(state="normal" if self.current_line_index > 0 else "disabled")
-        self.next_button.config(state="normal" if self.current_line_index < len(self.line_data) - 1 else "disabled")
+        self.prev_button.config(state="normal" if self.review_position > 0 else "disabled")
+        self.next_button.config(state="normal" if self.review_position < len(self.review_order) - 1 else "disabled")
+        self.next_doubtful_button.config(state="normal")
 
     def save_current_line_text(self):
-        if self.line_data:
-            self.line_data[self.current_line_index]['text'] = self.text_entry.get()
+        if self.line_data and self.review_order:
+            line = self.line_data[self.current_line_index]
+            text = self.text_entry.get()
+            if text != line['text']:
+                line['text'] = text
+                if self.journal is not None:
+                    self.journal.put(line)
 
     def show_previous_line(self):
         self.save_current_line_text()
-        if self.current_line_index > 0:
-            self.current_line_index -= 1
+        if self.review_position > 0:
+            self.review_position -= 1
             self.display_line()
 
     def show_next_line(self):
         self.save_current_line_text()
-        if self.current_line_index < len(self.line_data) - 1:
-            self.current_line_index += 1
+        if self.review_position < len(self.review_order) - 1:
+            self.review_position += 1
             self.display_line()
 
+    def show_next_doubtful_line(self):
+        """
+        Jumps to the next line (in review order, wrapping around) under REVIEW_CONFIDENCE_THRESHOLD.
+        """
+        self.save_current_line_text()
+        n_positions = len(self.review_order)
+        for step in range(1, n_positions):
+            position = (self.review_position + step) % n_positions
+            if self.line_confidence(self.line_data[self.review_order[position]]) < REVIEW_CONFIDENCE_THRESHOLD:
+                self.review_position = position
+                self.display_line()
+                return
+        self.info_label.config(text=f"No other lines under confidence {REVIEW_CONFIDENCE_THRESHOLD:.0f}.")
+
     def finish(self):
         self.save_current_line_text()
         global GLOBAL_LINE_DATA
@@ -365,51 +2543,751 @@ class TkVerifyWords(tk.Toplevel):
         self.destroy()
 
 
+# --- Unicharset ---
+
+# unicodedata.bidirectional() classes -> ICU UCharDirection values, as written by unicharset_extractor
+UNICHARSET_DIRECTIONS = {'L': 0, 'R': 1, 'EN': 2, 'ES': 3, 'ET': 4, 'AN': 5, 'CS': 6, 'B': 7, 'S': 8, 'WS': 9,
+                         'ON': 10, 'LRE': 11, 'LRO': 12, 'AL': 13, 'RLE': 14, 'RLO': 15, 'PDF': 16, 'NSM': 17,
+                         'BN': 18, 'FSI': 19, 'LRI': 20, 'RLI': 21, 'PDI': 22}
+UNICHARSET_SCRIPTS = ('Latin', 'Greek', 'Cyrillic', 'Hebrew', 'Arabic', 'Armenian', 'Georgian', 'Coptic', 'Runic',
+                      'Gothic', 'Devanagari', 'Syriac', 'Ethiopic')
+
+
+def normalize_gt_text(text):
+    text = unicodedata.normalize('NFC', text)
+    for source, target in UNICHARSET_NORMALIZATION_MAP.items():
+        text = text.replace(source, target)
+    return text
+
+
+def split_graphemes(text):
+    """
+    Splits text into characters, keeping combining marks with their base character. Whitespace is dropped.
+    """
+    graphemes = []
+    for char in text:
+        if unicodedata.combining(char) and graphemes:
+            graphemes[-1] += char
+        elif not char.isspace():
+            graphemes.append(char)
+    return graphemes
+
+
+def count_gt_characters(gt_txt_path):
+    with open(gt_txt_path, encoding='utf-8') as f:
+        return Counter(split_graphemes(normalize_gt_text(f.read())))
+
+
+def _unichar_properties(unichar):
+    base = unichar[0]
+    props = 0
+    if base.isalpha():
+        props |= 1
+    if base.islower():
+        props |= 2
+    if base.isupper():
+        props |= 4
+    if base.isdigit():
+        props |= 8
+    if unicodedata.category(base).startswith('P'):
+        props |= 16
+
+    name = unicodedata.name(base, '')
+    script = next((s for s in UNICHARSET_SCRIPTS if name.startswith(s.upper())), 'Common')
+    direction = UNICHARSET_DIRECTIONS.get(unicodedata.bidirectional(base), 10)
+
+    if props & 8:
+        kind = '0'
+    elif props & 2:
+        kind = 'a'
+    elif props & 4:
+        kind = 'A'
+    elif props & 1:
+        kind = 'x'
+    else:
+        kind = 'p'
+    return props, script, direction, kind
+
+
+def write_unicharset(char_counts, output_path):
+    """
+    Writes the characters of char_counts as a Tesseract unicharset (same layout as unicharset_extractor).
+    """
+    unichars = sorted(char_counts)
+    ids = {unichar: i for i, unichar in enumerate(unichars, 3)}  # 0, 1 and 2 are Tesseract's special unichars
+
+    lines = [str(len(unichars) + 3),
+             "NULL 0 Common 0 0 0 0 0 NULL",
+             "Joined 7 0,255,0,255,0,0,0,0,0,0 Latin 1 0 1 Joined\t# Joined [4a 6f 69 6e 65 64 ]a",
+             "|Broken|0|1 15 0,255,0,255,0,0,0,0,0,0 Common 2 10 2 |Broken|0|1\t# Broken"]
+    for unichar in unichars:
+        props, script, direction, kind = _unichar_properties(unichar)
+        other_case = ids.get(unichar.swapcase(), ids[unichar])
+        codes = ' '.join(f"{ord(c):x}" for c in unichar)
+        lines.append(f"{unichar} {props:x} 0,255,0,255,0,0,0,0,0,0 {script} {other_case} {direction} "
+                     f"{ids[unichar]} {unichar}\t# {unichar} [{codes} ]{kind}")
+
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def build_unicharset(gt_dir, output_path, report_path=None, threads=UNICHARSET_THREADS):
+    """
+    Builds the unicharset of all the .gt.txt files in gt_dir, without unicharset_extractor.
+    The texts are NFC normalised (plus UNICHARSET_NORMALIZATION_MAP); the .gt.txt files are listed once and the
+    characters of every file are kept in an index in gt_dir, so a rerun only counts the new or changed files.
+    Their texts come from the folder's GtManifest when it is newer than the file, else from the file itself
+    (read in a thread pool).
+    A per-character frequency report is written to report_path (default: next to output_path, .freq.tsv).
+    Returns the Counter of all the characters.
+    """
+    index_path = os.path.join(gt_dir, UNICHARSET_INDEX)
+    normalization = unicodedata.unidata_version + json.dumps(UNICHARSET_NORMALIZATION_MAP, sort_keys=True)
+    try:
+        with open(index_path, encoding='utf-8') as f:
+            index = json.load(f)
+        if index.get('normalization') != normalization:
+            index = {}
+    except (OSError, ValueError):
+        index = {}
+    files = index.get('files', {})
+
+    current = {}
+    with os.scandir(gt_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.gt.txt') and entry.is_file():
+                stat = entry.stat()
+                current[entry.name] = [stat.st_mtime, stat.st_size]
+    to_read = [name for name, stamp in current.items() if files.get(name, {}).get('stamp') != stamp]
+
+    # A text saved after its file was last written is taken from the manifest; the others (no row, or a
+    # .gt.txt changed by hand since) are read from the files
+    manifest = GtManifest(gt_dir)
+    saved_texts = {}
+    if manifest.exists():
+        saved_texts = {f"{name}.gt.txt": text for name, text, _, updated in manifest.lines()
+                       if f"{name}.gt.txt" in current and updated >= current[f"{name}.gt.txt"][0]}
+    to_open = [name for name in to_read if name not in saved_texts]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        counts = dict(zip(to_open, pool.map(count_gt_characters, [os.path.join(gt_dir, name) for name in to_open])))
+    for name in to_read:
+        file_counts = counts[name] if name in counts else Counter(split_graphemes(normalize_gt_text(saved_texts[name])))
+        files[name] = {'stamp': current[name], 'chars': dict(file_counts)}
+    files = {name: data for name, data in files.items() if name in current}
+    print(f"Unicharset: {len(to_read)} new or changed lines read, {len(current) - len(to_read)} from the index.")
+
+    total = Counter()
+    for data in files.values():
+        total.update(data['chars'])
+
+    write_unicharset(total, output_path)
+
+    report_path = report_path or os.path.splitext(output_path)[0] + '.freq.tsv'
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write("char\tcodepoints\tcount\n")
+        for unichar, count in total.most_common():
+            f.write(f"{unichar}\t{' '.join(f'U+{ord(c):04X}' for c in unichar)}\t{count}\n")
+
+    tmp_path = f"{index_path}.tmp{RUNTIME_ID}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'normalization': normalization, 'files': files}, f, ensure_ascii=False)
+    os.replace(tmp_path, index_path)
+    return total
+
+
+# --- LSTMF ---
+
+def write_line_box(tif_path, gt_txt_path, box_path):
+    """
+    Writes the WordStr .box file of a line image, as tesstrain's generate_line_box.py does.
+    """
+    with Image.open(tif_path) as image:
+        width, height = image.size
+    with open(gt_txt_path, encoding='utf-8') as f:
+        text = f.read().strip()
+    with open(box_path, 'w', encoding='utf-8') as f:
+        f.write(f"WordStr 0 0 {width} {height} 0 #{text}\n")
+        f.write(f"\t {width} 0 {width + 1} 1 0\n")
+
+
+def lstm_train_config(lstmf_dir):
+    """
+    Path of the lstm.train config for tesseract. The repo's tessdata has only the models, so the config is looked
+    for in TESSDATA_FOLDER, TESSDATA_PREFIX and the tessdata of the installed tesseract; if none has it,
+    LSTM_TRAIN_PARAMS are written into lstmf_dir. Without the config tesseract only warns and writes no .lstmf.
+    """
+    tessdata_dirs = [TESSDATA_FOLDER, os.environ.get('TESSDATA_PREFIX')]
+    try:
+        listed = subprocess.run(['tesseract', '--list-langs'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # First line: List of available languages in "/usr/share/tesseract-ocr/5/tessdata/" (3):
+        match = re.search(r'"(.+?)"', (listed.stdout + listed.stderr).decode(errors='replace'))
+        if match:
+            tessdata_dirs.append(match.group(1))
+    except FileNotFoundError:
+        pass
+    for tessdata_dir in filter(None, tessdata_dirs):
+        config_path = os.path.join(tessdata_dir, 'configs', 'lstm.train')
+        if os.path.exists(config_path):
+            return os.path.abspath(config_path)
+
+    config_path = os.path.abspath(os.path.join(lstmf_dir, 'lstm.train'))
+    with open(config_path, 'w', encoding='utf-8') as f:
+        f.writelines(f"{name} {value}\n" for name, value in LSTM_TRAIN_PARAMS.items())
+    return config_path
+
+
+def _lstmf_worker(base, lstmf_dir, lang, config_path='lstm.train', stale=False):
+    tif_path, gt_txt_path = base + '.tif', base + '.gt.txt'
+    lstmf_base = os.path.join(lstmf_dir, os.path.basename(base))
+    lstmf_path = lstmf_base + '.lstmf'
+
+    try:
+        if stale:
+            os.remove(lstmf_path)  # Out of date: its presence must not hide a failed run
+        write_line_box(tif_path, gt_txt_path, base + '.box')  # Tesseract looks for it next to the image
+        env = dict(os.environ, OMP_THREAD_LIMIT='1')  # One core per process, the pool does the rest
+        # tesseract looks for the config in <tessdata>/configs, then takes it as a path
+        result = subprocess.run(['tesseract', tif_path, lstmf_base, '--tessdata-dir',
+                                 os.path.abspath(TESSDATA_FOLDER), '-l', lang, '--psm', '13', config_path],
+                                check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        if not os.path.exists(lstmf_path):
+            # e.g. "Can't open lstm.train": tesseract exits with 0 after writing a .txt instead
+            message = result.stderr.decode(errors='replace').strip()
+            return lstmf_path, 'failed', f"tesseract wrote no .lstmf file. {message}".strip()
+        return lstmf_path, 'written', None
+    except FileNotFoundError:
+        return lstmf_path, 'failed', ("'tesseract' command not found. "
+                                      "Please ensure Tesseract is installed and in your PATH.")
+    except subprocess.CalledProcessError as e:
+        return lstmf_path, 'failed', e.stderr.decode(errors='replace').strip()
+    except Exception as e:
+        return lstmf_path, 'failed', str(e)
+
+
+def is_eval_line(name, eval_ratio=LSTMF_EVAL_RATIO):
+    """
+    Deterministic train/eval split: it depends only on the line name, so adding lines never moves the others.
+    """
+    return int(hashlib.sha1(name.encode('utf-8')).hexdigest()[:8], 16) / 0xFFFFFFFF < eval_ratio
+
+
+def gt_corpus(gt_dir):
+    """
+    {name: last change} of the .tif/.gt.txt pairs of gt_dir, from a single listing of the folder. The last change
+    is the newest of the mtimes of the pair and of its row in the folder's GtManifest, so a .gt.txt fixed by hand
+    counts as changed. Pairs without a manifest row (saved by older versions, or copied in) are part of the corpus
+    too; rows without their files (lines still in shards) are not.
+    """
+    with os.scandir(gt_dir) as entries:
+        mtimes = {entry.name: entry.stat().st_mtime for entry in entries if entry.is_file()}
+    corpus = {}
+    for file_name, mtime in mtimes.items():
+        name = file_name[:-len('.gt.txt')]
+        if file_name.endswith('.gt.txt') and f"{name}.tif" in mtimes:
+            corpus[name] = max(mtime, mtimes[f"{name}.tif"])
+
+    manifest = GtManifest(gt_dir)
+    if manifest.exists():
+        for name, _, _, updated in manifest.lines():
+            if name in corpus:
+                corpus[name] = max(corpus[name], updated)
+    return corpus
+
+
+def generate_lstmf_files(gt_dir, lstmf_dir, lang, workers=None, eval_ratio=LSTMF_EVAL_RATIO):
+    """
+    Runs tesseract's lstm.train on every .tif/.gt.txt pair of gt_dir with at most `workers` processes at a time,
+    skipping the pairs whose .lstmf is newer than the time they were saved, then writes all-lstmf, list.train and
+    list.eval. The pairs come from gt_corpus and the split from the folder's GtManifest (is_eval_line for the
+    pairs it doesn't know); the .lstmf files are listed once.
+    """
+    os.makedirs(lstmf_dir, exist_ok=True)
+    corpus = gt_corpus(gt_dir)
+    if not corpus:
+        print(f"No .tif/.gt.txt pairs found in '{gt_dir}'.")
+        return
+    if os.path.exists(os.path.join(gt_dir, GtShardStore.INDEX)):
+        print("Lines saved in shards need their .tif/.gt.txt files: run --export-shards first.")
+
+    with os.scandir(lstmf_dir) as entries:
+        lstmf_mtimes = {entry.name[:-len('.lstmf')]: entry.stat().st_mtime for entry in entries
+                        if entry.name.endswith('.lstmf')}
+    lstmf_files = [os.path.join(lstmf_dir, name + '.lstmf') for name in sorted(corpus)
+                   if lstmf_mtimes.get(name, 0) > corpus[name]]
+    to_build = sorted(name for name in corpus if lstmf_mtimes.get(name, 0) <= corpus[name])
+
+    workers = workers or os.cpu_count() or 1
+    print(f"Generating .lstmf files for {len(to_build)} of {len(corpus)} lines with {workers} processes...")
+    start = perf_counter()
+    statuses = Counter(unchanged=len(lstmf_files))
+    config_path = lstm_train_config(lstmf_dir)
+    # Every thread just waits for its tesseract process: the pool bounds how many processes run at once
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = pool.map(lambda name: _lstmf_worker(os.path.join(gt_dir, name), lstmf_dir, lang, config_path,
+                                                      stale=name in lstmf_mtimes), to_build)
+        for lstmf_path, status, error in results:
+            statuses[status] += 1
+            if status == 'failed':
+                print(f"Error generating {os.path.basename(lstmf_path)}: {error}")
+            else:
+                lstmf_files.append(lstmf_path)
+
+    print(f"{statuses['written']} .lstmf files generated, {statuses['unchanged']} up to date, "
+          f"{statuses['failed']} failed in {perf_counter() - start:.1f}s.")
+
+    manifest = GtManifest(gt_dir)
+    train_names, evaluation_names = manifest.train_eval_split(eval_ratio) if manifest.exists() else ([], [])
+    known = set(train_names) | set(evaluation_names)
+    evaluation_names = set(evaluation_names) | {name for name in corpus
+                                                 if name not in known and is_eval_line(name, eval_ratio)}
+    lstmf_files.sort()
+    train, evaluation = [], []
+    for lstmf_path in lstmf_files:
+        name = os.path.splitext(os.path.basename(lstmf_path))[0]
+        (evaluation if name in evaluation_names else train).append(lstmf_path)
+    for list_name, paths in (('all-lstmf', lstmf_files), ('list.train', train), ('list.eval', evaluation)):
+        with open(os.path.join(lstmf_dir, list_name), 'w', encoding='utf-8') as f:
+            f.writelines(f"{path}\n" for path in paths)
+    print(f"Lists written to '{lstmf_dir}': {len(train)} training and {len(evaluation)} evaluation lines.")
+
+
+# --- Batch (headless) Processing ---
+
+BATCH_IMAGE_EXTENSIONS = DOCUMENT_EXTENSIONS
+
+_WORKER_LANG = None
+
+
+def find_batch_images(source):
+    """
+    Resolves the --batch argument (a directory or a glob pattern) into a sorted list of image paths.
+    """
+    if os.path.isdir(source):
+        candidates = glob.glob(os.path.join(source, '*'))
+    else:
+        candidates = glob.glob(source)
+    return sorted(os.path.abspath(p) for p in candidates
+                  if os.path.isfile(p) and p.lower().endswith(BATCH_IMAGE_EXTENSIONS))
+
+
+def _init_batch_worker(lang, instrument=False):
+    global _WORKER_LANG
+    _WORKER_LANG = lang  # OMP_THREAD_LIMIT is set before tesserocr is imported, see the imports
+    if instrument:
+        INSTRUMENTS.enable()
+        INSTRUMENTS.take()  # A forked worker starts with a copy of the parent's records
+    if USE_TESSEROCR:
+        try:
+            with ENGINE_POOL.engine(lang):  # Load the model once per worker process
+                pass
+        except Exception as e:
+            print(f"Worker {os.getpid()}: could not load tesserocr ({e})")
+
+
+def _batch_pages(image_files):
+    """
+    (path, page index) of every page of the files; the page is None for single-page files.
+    """
+    for image_path in image_files:
+        try:
+            n_pages = len(PageDocument(image_path))
+        except Exception as e:
+            print(f"{os.path.basename(image_path)}: cannot be opened ({e})")
+            continue
+        if n_pages == 1:
+            yield image_path, None
+        else:
+            for index in range(n_pages):
+                yield image_path, index
+
+
+def _batch_worker(item, output_dir):
+    image_path, page = item
+    base_filename = os.path.splitext(os.path.basename(image_path))[0]
+    try:
+        # Every worker decodes only its own page of the document
+        image = preprocess_page(PageDocument(image_path).page(page or 0))
+        line_data = extract_text_lines(image, _WORKER_LANG)
+        if line_data:
+            save_gt_files(line_data, base_filename, output_dir=output_dir, threads=1,  # The pool is already parallel
+                          page=page)
+        return image_path, page, len(line_data), None, INSTRUMENTS.take()
+    except Exception as e:
+        return image_path, page, 0, str(e), INSTRUMENTS.take()
+
+
+def run_batch(source, lang, output_dir=None, workers=None):
+    """
+    Segments and recognises every page matched by source in a process pool, saving draft .tif/.gt.txt pairs.
+    Args:
+        source (str): directory or glob pattern of images, multi-page TIFFs and PDFs.
+        lang (str): Tesseract language label of the model.
+        output_dir (str): directory for the draft GT files (defaults to DRAFT_GT_OUTPUT_DIR).
+        workers (int): number of worker processes (defaults to the number of CPUs).
+    """
+    output_dir = output_dir or DRAFT_GT_OUTPUT_DIR
+    image_files = find_batch_images(source)
+    if not image_files:
+        print(f"No images found for batch source: {source}")
+        return
+
+    pages = list(_batch_pages(image_files))
+    if not pages:
+        print(f"No pages could be read from: {source}")
+        return
+    workers = max(1, min(workers or os.cpu_count() or 1, max(1, len(pages))))
+    print(f"Batch processing {len(pages)} pages of {len(image_files)} files with {workers} workers...")
+
+    start = perf_counter()
+    total_lines = 0
+    failed = 0
+    with Pool(processes=workers, initializer=_init_batch_worker, initargs=(lang, INSTRUMENTS.enabled)) as pool:
+        worker = partial(_batch_worker, output_dir=output_dir)
+        for done, (image_path, page, n_lines, error, records) in enumerate(pool.imap_unordered(worker, pages), 1):
+            INSTRUMENTS.merge(*records)  # Timings and counters of the worker process
+            name = os.path.basename(image_path) + (f" p.{page + 1}" if page is not None else "")
+            if error:
+                failed += 1
+                print(f"[{done}/{len(pages)}] {name}: FAILED ({error})")
+            else:
+                total_lines += n_lines
+                print(f"[{done}/{len(pages)}] {name}: {n_lines} lines")
+
+    elapsed = perf_counter() - start
+    if INSTRUMENTS.enabled:
+        INSTRUMENTS.add_span('batch.run', elapsed)
+    print(f"Batch finished: {total_lines} lines from {len(pages) - failed} pages "
+          f"in {elapsed:.1f}s ({failed} failed). Draft GT files are in '{output_dir}'.")
+
+
+# --- Benchmark (headless) ---
+
+def benchmark_variants(image, variants=BENCHMARK_VARIANTS):
+    """
+    Yields (name, image) for the variants of a fixture page: as it is, upscaled 2x, tiled 2x2.
+    """
+    for name in variants:
+        if name == 'original':
+            yield name, image
+        elif name == 'upscale2x':
+            yield name, image.resize((image.width * 2, image.height * 2), Image.LANCZOS)
+        elif name == 'tile2x2':
+            tiled = Image.new(image.mode, (image.width * 2, image.height * 2), "white")
+            for x, y in itertools.product((0, image.width), (0, image.height)):
+                tiled.paste(image, (x, y))
+            yield name, tiled
+        else:
+            raise ValueError(f"Unknown benchmark variant: {name}")
+
+
+def reference_text(base_filename, gt_dir=GT_OUTPUT_DIR):
+    """
+    The .gt.txt lines of a page in gt_dir, in line order and joined by newlines (None if there are none).
+    """
+    paths = sorted(glob.glob(os.path.join(gt_dir, glob.escape(base_filename) + "_l*.gt.txt")))
+    if not paths:
+        return None
+    lines = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            lines.append(f.read().strip())
+    return "\n".join(lines)
+
+
+def character_error_rate(reference, hypothesis):
+    """
+    Edits (substituted, inserted and deleted characters) needed to turn hypothesis into reference,
+    per reference character, counted on the opcodes of SequenceMatcher.
+    """
+    if not reference:
+        return 0.0 if not hypothesis else 1.0
+    matcher = SequenceMatcher(None, reference, hypothesis, autojunk=False)
+    edits = sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal')
+    return edits / len(reference)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB on Linux
+
+
+def benchmark_page(image, lang, reference=None):
+    """
+    Extracts the lines of a page and saves them in a temporary folder, measuring both.
+    """
+    INSTRUMENTS.take()
+    start = perf_counter()
+    lines = extract_text_lines(image, lang)
+    ocr_seconds = perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as gt_dir:
+        start = perf_counter()
+        if lines:
+            save_gt_files(lines, 'benchmark', output_dir=gt_dir)
+        write_seconds = perf_counter() - start
+    spans, counters = INSTRUMENTS.take()
+
+    return {
+        'lines': len(lines),
+        'ocr_seconds': ocr_seconds,
+        'lines_per_second': len(lines) / ocr_seconds if ocr_seconds > 0 else None,
+        'ms_per_line': ocr_seconds * 1000 / len(lines) if lines else None,
+        'gt_write_seconds': write_seconds,
+        'gt_bytes_written': counters.get('gt.bytes_written', 0),
+        'cer': character_error_rate(reference, "\n".join(line['text'] for line in lines))
+        if reference is not None else None,
+        # Of the whole process so far, not of this page alone: it can only grow from a variant to the next
+        'process_peak_rss_mb': peak_rss_mb(),
+        'spans_ms': {name: total * 1000 for name, (_, total, _) in spans.items()},
+    }
+
+
+def compare_with_baseline(results, baseline):
+    """
+    Regressions of results against a baseline: slower OCR or GT writing, higher CER, a different number of lines.
+    """
+    regressions = []
+    for key, result in results.items():
+        base = baseline.get('results', {}).get(key)
+        if base is None:
+            continue
+        for metric in ('ocr_seconds', 'gt_write_seconds'):
+            if base.get(metric) and result[metric] > base[metric] * (1 + BENCHMARK_TOLERANCE):
+                regressions.append(f"{key}: {metric} {result[metric]:.3f}s (baseline {base[metric]:.3f}s)")
+        if result['cer'] is not None and base.get('cer') is not None and \
+                result['cer'] > base['cer'] + BENCHMARK_CER_TOLERANCE:
+            regressions.append(f"{key}: CER {result['cer']:.4f} (baseline {base['cer']:.4f})")
+        if result['lines'] != base.get('lines'):
+            regressions.append(f"{key}: {result['lines']} lines (baseline {base.get('lines')})")
+    return regressions
+
+
+def run_benchmark(fixtures=None, lang=BENCHMARK_LANGUAGE, baseline_path=BENCHMARK_BASELINE, save_baseline=False,
+                  variants=BENCHMARK_VARIANTS):
+    """
+    Measures segmentation, recognition and GT writing on the fixture pages and their variants (with the OCR
+    cache off): wall time, lines per second, peak RSS of the process so far and CER against the .gt.txt files in
+    GT_OUTPUT_DIR. The results are compared with the baseline in baseline_path, or saved as the new baseline
+    with save_baseline; without a baseline nothing is measured.
+    Args:
+        fixtures (list): page images (default BENCHMARK_FIXTURES).
+        lang (str): Tesseract language label of the model.
+        baseline_path (str): JSON file of the baseline results.
+        save_baseline (bool): write these results as the baseline instead of comparing them.
+        variants (tuple): names of the variants of every page (see benchmark_variants).
+    Returns:
+        list: the regressions found (empty if none, or if the baseline was saved), None if there is no baseline.
+    """
+    global USE_OCR_CACHE
+    if not save_baseline and not os.path.exists(baseline_path):
+        print(f"No baseline in {baseline_path}: run the benchmark with --save-baseline to create it.")
+        return None
+
+    fixtures = fixtures or BENCHMARK_FIXTURES
+    use_ocr_cache, USE_OCR_CACHE = USE_OCR_CACHE, False  # Every run must really OCR the page
+    was_enabled = INSTRUMENTS.enabled
+    INSTRUMENTS.enabled = True  # The spans split the time among model loading, recognition, encoding...
+    records = INSTRUMENTS.take()
+
+    results = {}
+    try:
+        start = perf_counter()
+        if USE_TESSEROCR:
+            with ENGINE_POOL.engine(lang):  # Load the model before timing the pages
+                pass
+        model_load_seconds = perf_counter() - start
+
+        for fixture in fixtures:
+            base_filename = os.path.splitext(os.path.basename(fixture))[0]
+            reference = reference_text(base_filename)
+            with Image.open(fixture) as page:
+                page = page.convert("RGB")
+            for variant, image in benchmark_variants(page, variants):
+                key = f"{base_filename}/{variant}"
+                print(f"Benchmark {key} {image.size}...")
+                # Only the original and the upscaled page have the reference lines in the same order
+                result = benchmark_page(image, lang, reference if variant in ('original', 'upscale2x') else None)
+                result['size'] = list(image.size)
+                results[key] = result
+    finally:
+        USE_OCR_CACHE = use_ocr_cache
+        INSTRUMENTS.enabled = was_enabled
+        INSTRUMENTS.merge(*records)
+
+    print(f"\nModel load: {model_load_seconds:.2f}s")
+    print(f"{'page/variant':<48}{'lines':>6}{'OCR s':>9}{'lines/s':>9}{'GT s':>8}{'CER':>8}{'proc RSS':>9}")
+    for key, result in results.items():
+        print(f"{key:<48}{result['lines']:>6}{result['ocr_seconds']:>9.2f}{result['lines_per_second'] or 0:>9.1f}"
+              f"{result['gt_write_seconds']:>8.2f}"
+              f"{'-' if result['cer'] is None else format(result['cer'], '.4f'):>8}"
+              f"{'-' if result['process_peak_rss_mb'] is None else format(result['process_peak_rss_mb'], '.0f'):>9}")
+
+    report = {
+        'runtime_id': RUNTIME_ID,
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+            'tesseract': tesserocr.tesseract_version().split()[1] if USE_TESSEROCR else None, 'lang': lang,
+            'ocr_single_pass': OCR_SINGLE_PASS, 'leftover_regions': USE_MSER_TO_FIND_LEFTOVER_REGIONS,
+            'preprocess_steps': PAGE_PREPROCESS_STEPS,
+        },
+        'model_load_seconds': model_load_seconds,
+        'results': results,
+    }
+
+    if save_baseline:
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {baseline_path}")
+        return []
+
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare_with_baseline(results, baseline)
+    if regressions:
+        print(f"{len(regressions)} regressions against {baseline_path}:")
+        for regression in regressions:
+            print(f"  {regression}")
+    else:
+        print(f"No regressions against {baseline_path}.")
+    return regressions
+
+
 # --- Main Execution Logic ---
 
+def run_gui_page(document, index, base_filename, prefetcher):
+    """
+    Runs the GUI workflow (boxes, verification, saving) on a page of a document.
+    Returns True if the GT files of the page were saved.
+    """
+    global GLOBAL_LINE_DATA
+    GLOBAL_LINE_DATA = []
+    page = document.page_number(index)
+
+    # An unsaved session of this page (crash or Escape) can be resumed without running the OCR again
+    journal = SessionJournal(document.path, page=page)
+    journal_lines, journal_stage = journal.load()
+    restore = False
+    if journal_lines:
+        restore = askyesno("Resume session", f"An unsaved session of this page with {len(journal_lines)} "
+                                             f"lines was found. Resume it without running the OCR again?")
+        if not restore:
+            journal.close(discard=True)
+
+    try:
+        image, ocr_future = prefetcher.take(index)
+    except Exception as e:
+        print(f"Error opening page {index + 1} of {document.path}: {e}")
+        return False
+    finally:
+        prefetcher.prefetch(index + 1)
+
+    if restore and journal_stage.get('step') == 'verify':
+        # The boxes were already finished: go straight back to the verification
+        GLOBAL_LINE_DATA = journal.restore(image)
+        print(f"Session restored: {len(GLOBAL_LINE_DATA)} lines")
+    else:
+        page_label = f" - page {index + 1}/{len(document)}" if document.multi_page else ""
+        tkgui_draw = TkDrawBorders(document.path, journal=journal, restore=restore, image=image,
+                                   ocr_future=None if restore else ocr_future, page_label=page_label)
+        tkgui_draw.wait_window()
+
+    if GLOBAL_LINE_DATA:
+        tkgui_verify = TkVerifyWords(line_data=GLOBAL_LINE_DATA, journal=journal)
+        tkgui_verify.wait_window()
+
+        if GLOBAL_LINE_DATA:
+            save_gt_files(GLOBAL_LINE_DATA, base_filename, page=page)
+            journal.close(discard=True)
+            print("Line-based ground truth files (.gt.txt and .tif) generated successfully.")
+            return True
+        print("No line data available after verification for saving GT files.")
+    else:
+        print("No line data generated during drawing phase. Skipping verification and GT file saving.")
+    return False
+
+
 def main(args, lang="eng"):
     freeze_support()
     # set_start_method('spawn', force=True) # Commented out, often not needed for macOS/Linux and can cause issues
 
-    input_handler = UserInputHandler()
-    input_handler.get_user_input()  # This now prompts for an image file
+    if args.get("instrument"):
+        INSTRUMENTS.enable(profiling=args.get("cprofile", False))
+        atexit.register(INSTRUMENTS.dump, args["instrument"])  # Also when the GUI is closed with Escape
 
-    if input_handler.kill:
-        print("Exiting.")
-        sys.exit(0)
+    if args.get("benchmark"):
+        regressions = run_benchmark(save_baseline=args.get("save_baseline", False))
+        sys.exit(2 if regressions is None else 1 if regressions else 0)
 
-    # The file is now an image path
-    image_file = os.path.abspath(input_handler.out_dict['file'])
+    if args.get("preprocess_benchmark"):
+        benchmark_preprocessing(args["preprocess_benchmark"], PAGE_PREPROCESS_STEPS or list(PREPROCESS_STEPS))
+        return
 
-    # Get base filename for GT output naming (no page number in this case)
-    base_filename = os.path.splitext(os.path.basename(image_file))[0]
+    if args.get("batch"):
+        run_batch(args["batch"], lang, output_dir=args.get("output_dir"), workers=args.get("workers"))
+        print("Pipeline execution finished.")
+        return
 
     # --- Workflow based on args ---
 
     run_gui_workflow = False
-    if args["linebox"] or not (args["postprocessing"] or args["unicharset"] or args["lstmf"] or args["retrain"]):
+    if args["linebox"] or not (args["postprocessing"] or args["unicharset"] or args["lstmf"] or args["retrain"]
+                               or args.get("export_shards")):
         run_gui_workflow = True
 
     if run_gui_workflow:
-        print("Running GUI for line-based ground truth generation...")
+        input_handler = UserInputHandler()
+        input_handler.get_user_input()  # This now prompts for an image file
 
-        # Pass image_file directly
-        tkgui_draw = TkDrawBorders(image_file)
-        tkgui_draw.wait_window()
+        if input_handler.kill:
+            print("Exiting.")
+            sys.exit(0)
 
-        if GLOBAL_LINE_DATA:
-            tkgui_verify = TkVerifyWords(line_data=GLOBAL_LINE_DATA)
-            tkgui_verify.wait_window()
+        # The file is an image, a multi-page TIFF or a PDF
+        image_file = os.path.abspath(input_handler.out_dict['file'])
 
-            if GLOBAL_LINE_DATA:
-                save_gt_files(GLOBAL_LINE_DATA, base_filename)
-                print("Line-based ground truth files (.gt.txt and .tif) generated successfully.")
-            else:
-                print("No line data available after verification for saving GT files.")
-        else:
-            print("No line data generated during drawing phase. Skipping verification and GT file saving.")
+        # Get base filename for GT output naming (the page number is added for multi-page documents)
+        base_filename = os.path.splitext(os.path.basename(image_file))[0]
+
+        print("Running GUI for line-based ground truth generation...")
+
+        try:
+            document = PageDocument(image_file)
+        except Exception as e:
+            print(f"Error opening {image_file}: {e}")
+            sys.exit(1)
 
-    if args["unicharset"]:
+        # While a page is corrected, the next one is decoded and OCR'd in background
+        prefetcher = PagePrefetcher(document, lang)
+        first_page = min(max(1, args.get("start_page") or 1), len(document)) - 1
+        try:
+            for index in range(first_page, len(document)):
+                if document.multi_page:
+                    print(f"--- Page {index + 1}/{len(document)} ---")
+                saved = run_gui_page(document, index, base_filename, prefetcher)
+                if index + 1 < len(document) and not saved and \
+                        not askyesno("Next page", f"Page {index + 1} was not saved. Go on with page {index + 2}?"):
+                    print(f"Stopped at page {index + 1}: restart with --start-page {index + 1} to go on from here.")
+                    break
+        finally:
+            prefetcher.shutdown()
+
+    if args.get("export_shards"):
+        print("Expanding GT shards into .tif/.gt.txt files...")
+        gt_dir = os.path.join(os.getcwd(), GT_OUTPUT_DIR)
+        written = shard_store(gt_dir).export() if os.path.exists(os.path.join(gt_dir, GtShardStore.INDEX)) else 0
+        print(f"{written} lines expanded into '{GT_OUTPUT_DIR}'.")
+
+    if args["unicharset"] and not USE_UNICHARSET_EXTRACTOR:
+        print("Generating unicharset file...")
+        unicharset_output_path = os.path.join(os.getcwd(), TESSDATA_FOLDER, f"{lang}.unicharset")
+        with INSTRUMENTS.span('unicharset.build'):
+            build_unicharset(os.path.join(os.getcwd(), GT_OUTPUT_DIR), unicharset_output_path)
+        print(f"Unicharset generated: {unicharset_output_path}")
+
+    if args["unicharset"] and USE_UNICHARSET_EXTRACTOR:
         print("Generating unicharset file...")
         unicharset_output_path = os.path.join(os.getcwd(), TESSDATA_FOLDER, f"{lang}.unicharset")
         gt_files_pattern = os.path.join(os.getcwd(), GT_OUTPUT_DIR, "*.gt.txt")
@@ -433,21 +3311,9 @@ def main(args, lang="eng"):
 
     if args["lstmf"]:
         print("Generating LSTMF training and evaluation files...")
-        lstmf_output_folder = os.path.join(os.getcwd(), LSTMF_FOLDER)
-        os.makedirs(lstmf_output_folder, exist_ok=True)
-
-        gt_tifs = sorted(glob.glob(os.path.join(os.getcwd(), GT_OUTPUT_DIR, "*.tif")))
-
-        list_file_path = os.path.join(lstmf_output_folder, "all_gt_files.txt")
-        with open(list_file_path, "w") as f:
-            for tif_file in gt_tifs:
-                base = os.path.splitext(tif_file)[0]
-                gt_txt = base + ".gt.txt"
-                if os.path.exists(gt_txt):
-                    f.write(f"{base}\n")
-
-        print("LSTMF generation is a complex step usually handled by tesstrain.sh's 'make training'.")
-        print(f"Ensure your .gt.txt and .tif files in '{GT_OUTPUT_DIR}' are ready for tesstrain.")
+        with INSTRUMENTS.span('lstmf.generate'):
+            generate_lstmf_files(os.path.join(os.getcwd(), GT_OUTPUT_DIR), os.path.join(os.getcwd(), LSTMF_FOLDER),
+                                 lang, workers=args.get("workers"))
 
     if args["retrain"]:
         print("Retraining Tesseract model...")
@@ -462,7 +3328,7 @@ class UserInputHandler:
     """Handles image file selection."""
 
     def __init__(self):
-        self.out_dict = {'file': None}  # No 'page' needed now
+        self.out_dict = {'file': None}  # Multi-page files are processed page by page
         self.kill = False
 
     def get_user_input(self):
@@ -470,8 +3336,9 @@ class UserInputHandler:
         root.withdraw()
 
         file_path = askopenfilename(
-            title="Select Image File for OCR",
-            filetypes=[("Image files", "*.jpg *.jpeg *.png")]  # Accept images
+            title="Select Image or Document for OCR",
+            filetypes=[("Images and documents", " ".join(f"*{ext}" for ext in DOCUMENT_EXTENSIONS)),
+                       ("Image files", "*.jpg *.jpeg *.png *.tif *.tiff"), ("PDF files", "*.pdf")]
         )
 
         if not file_path:
@@ -496,14 +3363,35 @@ if __name__ == '__main__':
                     help="Only generate LSTMF training and evaluation files from the .gt.txt files")
     ap.add_argument("-r", "--retrain", action="store_true",
                     help="Only retrain the Tesseract model from the LSTMF files")
+    ap.add_argument("-B", "--batch", type=str, default=None,
+                    help="Headless mode: OCR every image in a directory or glob pattern and save draft GT files")
+    ap.add_argument("-w", "--workers", type=int, default=None,
+                    help="Number of worker processes for --batch and --lstmf (default: number of CPUs)")
+    ap.add_argument("-o", "--output-dir", type=str, default=None,
+                    help=f"Output folder for --batch draft GT files (default: {DRAFT_GT_OUTPUT_DIR})")
+    ap.add_argument("-x", "--export-shards", action="store_true",
+                    help="Expand the GT lines packed in shards (GT_OUTPUT_FORMAT = 'shards') into .tif/.gt.txt files")
+    ap.add_argument("-s", "--start-page", type=int, default=1,
+                    help="First page of a multi-page TIFF or PDF to process in the GUI (default: 1)")
+    ap.add_argument("-i", "--instrument", type=str, default=None, metavar="PATH",
+                    help="Record timings and counters of the run and write them to PATH.json and PATH.csv")
+    ap.add_argument("--cprofile", action="store_true",
+                    help="With --instrument, also capture a cProfile of the OCR into PATH.prof")
+    ap.add_argument("--benchmark", action="store_true",
+                    help=f"Measure OCR and GT writing on the fixture pages and compare with {BENCHMARK_BASELINE}")
+    ap.add_argument("--save-baseline", action="store_true",
+                    help="With --benchmark, save the results as the new baseline")
+    ap.add_argument("--preprocess-benchmark", type=str, default=None, metavar="IMAGE",
+                    help="Time the page preprocessing steps (PAGE_PREPROCESS_STEPS, or all of them) on an image")
     ap.add_argument("-h", "--help", action="store_true", help="Display detailed help message.")
 
     args_parsed = ap.parse_args()
 
     if args_parsed.help:
         ap.print_help()
-        print("\nThis script is now modified to accept image files (JPG/PNG) directly as input.")
+        print("\nThis script accepts image files (JPG/PNG/TIFF) and multi-page TIFF or PDF documents as input.")
         print("Use -b to run the GUI to create line-based ground truth (.gt.txt and .tif files).")
+        print("Use -B <dir|glob> to pre-segment many images without the GUI, writing draft GT files.")
         print("Subsequent steps (--unicharset, --lstmf, --retrain) assume these .gt.txt/.tif files as input.")
         sys.exit(0)
 
@@ -0,0 +1,47 @@
+import os
+
+from PIL import Image
+
+import main
+
+
+def write_pair(gt_dir, name, text):
+    Image.new('L', (40, 12), 255).save(os.path.join(gt_dir, f"{name}.tif"))
+    with open(os.path.join(gt_dir, f"{name}.gt.txt"), 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def save_line(gt_dir, base_filename, text):
+    line = main.LineRecord(None, {'x': 0, 'y': 0, 'w': 40, 'h': 12}, text, 0, image=Image.new('L', (40, 12), 255))
+    main.save_gt_files([line], base_filename, output_dir=str(gt_dir))
+
+
+def test_corpus_keeps_pairs_without_manifest_rows(tmp_path):
+    write_pair(tmp_path, 'old_l000', 'abc')
+    write_pair(tmp_path, 'old_l001', 'def')
+    save_line(tmp_path, 'new', 'ghi')
+
+    assert main.GtManifest(str(tmp_path)).names() == ['new_l000']
+    assert sorted(main.gt_corpus(str(tmp_path))) == ['new_l000', 'old_l000', 'old_l001']
+
+
+def test_corpus_skips_unpaired_files(tmp_path):
+    write_pair(tmp_path, 'a_l000', 'abc')
+    os.remove(tmp_path / 'a_l000.gt.txt')
+
+    assert main.gt_corpus(str(tmp_path)) == {}
+
+
+def test_unicharset_counts_every_pair_and_hand_edits(tmp_path):
+    write_pair(tmp_path, 'old_l000', 'aab')
+    save_line(tmp_path, 'new', 'bc')
+    output = str(tmp_path / 'out.unicharset')
+
+    assert main.build_unicharset(str(tmp_path), output) == {'a': 2, 'b': 2, 'c': 1}
+
+    gt_txt_path = tmp_path / 'new_l000.gt.txt'
+    gt_txt_path.write_text('dd', encoding='utf-8')
+    stat = os.stat(gt_txt_path)
+    os.utime(gt_txt_path, (stat.st_atime, stat.st_mtime + 10))  # Edited by hand after the save
+
+    assert main.build_unicharset(str(tmp_path), output) == {'a': 2, 'b': 1, 'd': 2}
@@ -0,0 +1,39 @@
+from PIL import Image
+
+import main
+
+
+def page_lines(texts):
+    return [main.LineRecord(None, {'x': 0, 'y': 20 * i, 'w': 40, 'h': 12}, text, i,
+                            image=Image.new('L', (40, 12), 255)) for i, text in enumerate(texts)]
+
+
+def test_save_records_every_line(tmp_path):
+    main.save_gt_files(page_lines(['abc', 'de']), 'page', output_dir=str(tmp_path))
+    manifest = main.GtManifest(str(tmp_path))
+
+    assert manifest.names() == ['page_l000', 'page_l001']
+    assert [(name, text) for name, text, _, _ in manifest.lines()] == [('page_l000', 'abc'), ('page_l001', 'de')]
+    assert manifest.orphans() == ([], [])
+
+
+def test_unchanged_lines_are_not_rewritten(tmp_path):
+    main.save_gt_files(page_lines(['abc', 'de']), 'page', output_dir=str(tmp_path))
+    tif_path = tmp_path / 'page_l000.tif'
+    first_mtime = tif_path.stat().st_mtime_ns
+
+    main.save_gt_files(page_lines(['abc', 'fg']), 'page', output_dir=str(tmp_path))
+
+    assert tif_path.stat().st_mtime_ns == first_mtime
+    assert (tmp_path / 'page_l001.gt.txt').read_text(encoding='utf-8') == 'fg'
+
+
+def test_train_eval_split_is_stable(tmp_path):
+    main.save_gt_files(page_lines([f"line {i}" for i in range(30)]), 'page', output_dir=str(tmp_path))
+    manifest = main.GtManifest(str(tmp_path))
+
+    train, evaluation = manifest.train_eval_split(0.2)
+    assert sorted(train + evaluation) == manifest.names()
+    assert evaluation == [name for name in manifest.names() if main.is_eval_line(name, 0.2)]
+    by_source = manifest.train_eval_split(0.2, by_source=True)
+    assert [] in by_source  # A single source image: all its lines on the same side
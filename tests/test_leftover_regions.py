@@ -0,0 +1,68 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+import main
+
+
+def text_page(lines, line_height=16, pitch=40):
+    # Words as black blocks with ascender-like ticks joining each line to the next one
+    image = Image.new('L', (600, 60 + lines * pitch), 255)
+    draw = ImageDraw.Draw(image)
+    for i in range(lines):
+        y = 40 + i * pitch
+        for x in range(40, 540, 60):
+            draw.rectangle((x, y, x + 45, y + line_height), fill=0)
+        if i < lines - 1:
+            draw.line((45, y + line_height, 45, y + pitch), fill=0)
+    return image
+
+
+def test_true_runs_joins_small_gaps():
+    mask = np.array([0, 1, 1, 0, 1, 0, 0, 0, 1], dtype=bool)
+    assert [tuple(map(int, run)) for run in main._true_runs(mask)] == [(1, 3), (4, 5), (8, 9)]
+    assert [tuple(map(int, run)) for run in main._true_runs(mask, max_gap=1)] == [(1, 5), (8, 9)]
+    assert main._true_runs(np.zeros(4, dtype=bool)) == []
+
+
+def test_split_text_lines_cuts_at_valleys():
+    profile = np.array([0] + [50] * 10 + [3, 3] + [50] * 10 + [2] + [50] * 10 + [0])
+    assert main._split_text_lines(profile, 10) == [(0, 11), (11, 23), (23, 35)]
+
+
+def test_split_text_lines_terminates_on_tiny_line_height():
+    profile = np.array([0, 5, 5, 5, 5, 5, 5, 5, 5, 5, 0, 0] + [5] * 10)
+    lines = main._split_text_lines(profile, 1)
+    assert lines[0][0] == 0 and lines[-1][1] == len(profile)
+    assert all(start < stop for start, stop in lines)
+
+
+def test_leftover_regions_are_single_lines():
+    page = text_page(5)
+    covered = main.LineRecord(page, {'x': 40, 'y': 40, 'w': 500, 'h': 17}, 'first', 0)
+
+    regions = main.find_leftover_regions(page, [covered])
+
+    cores = [40 + i * 40 for i in range(1, 5)]
+    assert len(regions) == 4
+    for region in regions:  # Every region holds one whole line of the page
+        assert any(region['y'] <= y and y + 16 <= region['y'] + region['h'] for y in cores)
+        assert len([y for y in cores if region['y'] <= y + 8 < region['y'] + region['h']]) == 1
+
+
+def test_line_interval_index_matches_brute_force():
+    rng = np.random.default_rng(1)
+    bboxes = [{'x': int(x), 'y': int(y), 'w': int(w), 'h': int(h)}
+              for x, y, w, h in zip(rng.integers(0, 500, 60), rng.integers(0, 500, 60),
+                                    rng.integers(1, 200, 60), rng.integers(1, 40, 60))]
+    index = main.LineIntervalIndex(bboxes)
+    for x1, y1 in zip(rng.integers(0, 500, 50), rng.integers(0, 500, 50)):
+        x2, y2 = x1 + 80, y1 + 30
+        expected = sorted((b['x'], b['y'], b['x'] + b['w'], b['y'] + b['h']) for b in bboxes
+                          if b['y'] < y2 and b['y'] + b['h'] > y1 and b['x'] < x2 and b['x'] + b['w'] > x1)
+        assert sorted(index.overlapping(x1, y1, x2, y2)) == expected
+
+
+def test_covered_fraction():
+    index = main.LineIntervalIndex([{'x': 0, 'y': 0, 'w': 10, 'h': 10}, {'x': 5, 'y': 0, 'w': 10, 'h': 10}])
+    assert index.covered_fraction(0, 0, 20, 10) == 0.75
+    assert index.covered_fraction(0, 20, 10, 30) == 0.0
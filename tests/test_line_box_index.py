@@ -0,0 +1,39 @@
+import random
+
+import main
+
+
+def brute_force_overlapping(boxes, x1, y1, x2, y2):
+    return sorted(uid for uid, (bx1, by1, bx2, by2) in boxes.items()
+                  if by1 <= y2 and by2 >= y1 and bx1 <= x2 and bx2 >= x1)
+
+
+def test_overlapping_matches_brute_force_through_edits():
+    rng = random.Random(2)
+    index, boxes = main.LineBoxIndex(), {}
+    for uid in range(80):
+        x, y = rng.randrange(500), rng.randrange(500)
+        boxes[uid] = (x, y, x + rng.randrange(1, 200), y + rng.randrange(1, 40))
+        index.insert(uid, *boxes[uid])
+    for uid in range(0, 80, 3):  # Moved
+        x, y = rng.randrange(500), rng.randrange(500)
+        boxes[uid] = (x, y, x + 50, y + 20)
+        index.insert(uid, *boxes[uid])
+    for uid in range(1, 80, 5):  # Deleted
+        del boxes[uid]
+        index.remove(uid)
+
+    assert len(index) == len(boxes)
+    for _ in range(100):
+        x1, y1 = rng.randrange(500), rng.randrange(500)
+        query = (x1, y1, x1 + rng.randrange(60), y1 + rng.randrange(30))
+        assert sorted(index.overlapping(*query)) == brute_force_overlapping(boxes, *query)
+
+
+def test_at_returns_smallest_box_first():
+    index = main.LineBoxIndex()
+    index.insert('page', 0, 0, 500, 500)
+    index.insert('line', 10, 10, 200, 30)
+    assert index.at(50, 20) == ['line', 'page']
+    assert index.at(250, 20) == ['page']
+    assert index.at(203, 20, margin=4) == ['line', 'page']
@@ -0,0 +1,36 @@
+import numpy as np
+from PIL import Image, ImageDraw
+
+import main
+
+
+def brute_force_sauvola(gray, window, k, r=128.0):
+    half = window // 2
+    padded = np.pad(gray.astype(np.float64), half, mode='reflect')
+    output = np.zeros(gray.shape, dtype=np.uint8)
+    for i in range(gray.shape[0]):
+        for j in range(gray.shape[1]):
+            patch = padded[i:i + window, j:j + window]
+            threshold = patch.mean() * (1 + k * (patch.std() / r - 1))
+            output[i, j] = 255 if gray[i, j] > threshold else 0
+    return output
+
+
+def test_sauvola_matches_centred_windows():
+    gray = np.random.default_rng(0).integers(0, 256, size=(40, 37)).astype(np.uint8)
+    assert np.array_equal(main.binarize_sauvola(gray, window=7, k=0.2), brute_force_sauvola(gray, 7, 0.2))
+
+
+def test_otsu_separates_two_levels():
+    gray = np.array([[30] * 10 + [200] * 10] * 4, dtype=np.uint8)
+    threshold = main.otsu_threshold(gray)
+    assert 30 <= threshold < 200
+
+
+def test_skew_angle_of_tilted_lines():
+    image = Image.new('L', (800, 400), 255)
+    draw = ImageDraw.Draw(image)
+    for y in range(60, 360, 40):
+        draw.line((50, y, 750, y + 24), fill=0, width=3)  # atan(24 / 700) = 1.96 degrees
+    angle = main.skew_angle(np.asarray(image))
+    assert abs(abs(angle) - 2.0) <= main.DESKEW_STEP
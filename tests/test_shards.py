@@ -0,0 +1,59 @@
+import io
+
+from PIL import Image
+
+import main
+
+
+def tif_bytes(color):
+    output = io.BytesIO()
+    Image.new('L', (40, 12), color).save(output, format='TIFF')
+    return output.getvalue()
+
+
+def test_read_returns_newest_copy(tmp_path):
+    store = main.GtShardStore(str(tmp_path))
+    store.append([('a_l000', b'one', b'first')])
+    store.append([('a_l000', b'two', b'second'), ('a_l001', b'three', b'third')])
+
+    assert store.names() == ['a_l000', 'a_l001']
+    assert store.read('a_l000') == (b'two', 'second')
+    assert 'a_l001' in store and 'a_l002' not in store
+    store.close()
+
+
+def test_shards_are_reused_until_full(tmp_path):
+    main.GtShardStore(str(tmp_path), max_bytes=1 << 20).append([('a_l000', b'x' * 100, b'a')])
+    main.GtShardStore(str(tmp_path), max_bytes=1 << 20).append([('b_l000', b'y' * 100, b'b')])
+    main.GtShardStore(str(tmp_path), max_bytes=1).append([('c_l000', b'z' * 100, b'c')])
+
+    shards = sorted(path.name for path in tmp_path.glob('*.tar'))
+    assert shards == ['gt-00000.tar', 'gt-00001.tar']
+    assert not list(tmp_path.glob('*.lock'))
+
+
+def test_export_rewrites_same_size_images(tmp_path):
+    store = main.GtShardStore(str(tmp_path / 'shards'))
+    (tmp_path / 'shards').mkdir()
+    output_dir = str(tmp_path / 'gt')
+    store.append([('a_l000', tif_bytes(255), b'text')])
+    assert store.export(output_dir) == 1
+    assert store.export(output_dir) == 0
+
+    moved = tif_bytes(0)  # Same size and text, another image
+    store.append([('a_l000', moved, b'text')])
+    assert store.export(output_dir) == 1
+    assert (tmp_path / 'gt' / 'a_l000.tif').read_bytes() == moved
+    store.close()
+
+
+def test_orphans_count_sharded_lines(tmp_path):
+    main.save_gt_files([main.LineRecord(None, {'x': 0, 'y': 0, 'w': 40, 'h': 12}, 'abc', 0,
+                                        image=Image.new('L', (40, 12), 255))], 'page', output_dir=str(tmp_path))
+    (tmp_path / 'page_l000.tif').unlink()
+    (tmp_path / 'page_l000.gt.txt').unlink()
+    manifest = main.GtManifest(str(tmp_path))
+    assert manifest.orphans() == ([], ['page_l000'])
+
+    main.GtShardStore(str(tmp_path)).append([('page_l000', tif_bytes(255), b'abc')])
+    assert manifest.orphans() == ([], [])